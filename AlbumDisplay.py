@@ -1,60 +1,40 @@
-from PIL import Image, ImageFont, ImageDraw, BdfFontFile
-from Log import log, LogCategory, LogLevel
-
-from fontTools.ttLib import TTFont
-
-
-def has_glyph(font, glyph):
-    for table in font['cmap'].tables:
-        if ord(glyph) in table.cmap.keys():
-            return True
-
-
-def font_supports_text(font, text):
-    f = TTFont(font)
-    return all([has_glyph(f, glyph) for glyph in text])
-
-
-def cut_text(img_draw, max_width, font, text):
-    width = img_draw.textlength(text, font=font)
-
-    if not width > max_width:
-        return text
-
-    width = img_draw.textlength(text + "...", font=font)
-
-    percent_over = max_width / width
-
-    pos_in_string = int(len(text) * percent_over)
+import hashlib
+import os
+import os.path
+import threading
 
-    if text[pos_in_string - 1] == " ":
-        pos_in_string -= 1
-
-    return text[:pos_in_string] + "..."
+from collections import OrderedDict
 
+from PIL import Image, ImageChops, ImageDraw, BdfFontFile
+from Fonts import fit_font, font_for_text, load_font
+from Log import log, LogCategory, LogLevel
+from TextLayout import truncate, wrap
 
-def line_wrap(img_draw, max_width, font, text):
-    width = img_draw.textlength(text, font=font)
-    if not width > max_width:
-        return text
 
-    words = text.split(" ")
+# Every pixel gets a class key with a bit field per channel: red < 10 (0),
+# in between (1) or > 200 (2), green >= 10 (4) and blue >= 10 (8). Black is
+# key 0, red (> 200, < 10, < 10) key 2.
+_CHANNEL_CLASS_TABLE = ([0] * 10 + [1] * 191 + [2] * 55 +
+                        [0] * 10 + [4] * 246 +
+                        [0] * 10 + [8] * 246)
+_BLACK_TABLE = [255 if key == 0 else 0 for key in range(256)]
+_RED_TABLE = [255 if key == 2 else 0 for key in range(256)]
+_NOT_RED_TABLE = [0 if key == 2 else 255 for key in range(256)]
 
-    final_string = ""
-    curr_line = ""
-    for i, word in enumerate(words):
-        word_width = img_draw.textlength(" " + word, font=font)
 
-        if (img_draw.textlength(f"{curr_line} {word}", font=font) >= max_width) or word_width >= max_width:
-            if word_width >= max_width:
-                word = cut_text(img_draw, max_width, font, word)
-            final_string += curr_line + "\n" + word + "\n"
-            curr_line = ""
-        else:
-            curr_line += word + " "
+def split_red(img):
+    # Split a red/black/white image into its black and red planes, as the
+    # mode "1" images (1 = white) the panels take. Red goes to the red plane
+    # and black only to the black one; anything else is thresholded into both.
+    img = img.convert('RGB')
+    r, g, b = img.point(_CHANNEL_CLASS_TABLE).split()
+    key = ImageChops.add(ImageChops.add(r, g), b)
 
-    final_string += curr_line
-    return final_string
+    plain = img.convert('1', dither=Image.NONE)
+    bw_plane = ImageChops.logical_or(plain, key.point(_RED_TABLE, '1'))
+    red_plane = ImageChops.logical_and(ImageChops.logical_or(plain, key.point(_BLACK_TABLE, '1')),
+                                       key.point(_NOT_RED_TABLE, '1'))
+    return bw_plane, red_plane
 
 
 def resize_image(image, target_height):
@@ -64,45 +44,152 @@ def resize_image(image, target_height):
     return image.resize((int(image.width * scale), int(image.height * scale)))
 
 
-def get_font(img_draw, font_name, fallback_name, sizes, text, allowed_width):
-    if not font_supports_text(font_name, text):
-        font_name = fallback_name
-    for i, size in enumerate(sizes):
-        font = ImageFont.truetype(font_name, size=size)
-        truncated = cut_text(img_draw, allowed_width, font, text)
-        if truncated == text or i == len(sizes) - 1:
-            log(LogLevel.INFO, LogCategory.INTERFACE,
-                f"Using font size {size}")
-            return font
+def get_font(fonts, sizes, text, allowed_width):
+    font = fit_font(tuple(fonts), tuple(sizes), text, allowed_width)
+    log(LogLevel.INFO, LogCategory.INTERFACE, f"Using font size {font.size}")
+    return font
+
+
+class RenderCache:
+    # Finished (bw, red) renders as PNGs in folder, keyed by the interface, its
+    # display size, the album art, the song fields the interface draws (its
+    # song_fields) and the dither settings. Once the folder grows past max_bytes the least
+    # recently used renders are deleted.
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+        # key -> bytes on disk, least recently used first
+        self.entries = OrderedDict()
+        renders = [f for f in os.listdir(folder) if f.endswith('.bw.png')]
+        renders.sort(key=lambda f: os.path.getmtime(os.path.join(folder, f)))
+        for render in renders:
+            key = render[:-len('.bw.png')]
+            if os.path.exists(self.paths(key)[1]):
+                self.entries[key] = sum(os.path.getsize(path) for path in self.paths(key))
+
+    def paths(self, key):
+        return (os.path.join(self.folder, f'{key}.bw.png'),
+                os.path.join(self.folder, f'{key}.red.png'))
+
+    def key(self, interface, album_img, song_info):
+        digest = hashlib.sha1()
+        with open(album_img, 'rb') as f:
+            digest.update(f.read())
+        fields = tuple(song_info[field] for field in interface.song_fields)
+        dither = getattr(interface.dither_function, 'settings', None)
+        digest.update(repr((type(interface).__name__, interface.img_width,
+                            interface.img_height, fields, dither)).encode())
+        return digest.hexdigest()
+
+    def create(self, interface, album_img, song_info):
+        # interface.create(album_img, song_info), from the cache if it's there
+        key = self.key(interface, album_img, song_info)
+        bw_path, red_path = self.paths(key)
+
+        with self.lock:
+            found = key in self.entries
+            if found:
+                self.entries.move_to_end(key)
+
+        if found:
+            try:
+                with Image.open(bw_path) as bw, Image.open(red_path) as red:
+                    bw_image, red_image = bw.copy(), red.copy()
+                # mtime is the LRU order when the cache is reloaded
+                os.utime(bw_path)
+                self.hits += 1
+                log(LogLevel.INFO, LogCategory.INTERFACE,
+                    f"{type(interface).__name__} render found in cache")
+                return bw_image, red_image
+            except OSError:
+                with self.lock:
+                    self.entries.pop(key, None)
+
+        self.misses += 1
+        bw_image, red_image = interface.create(album_img, song_info)
+
+        for img, path in ((bw_image, bw_path), (red_image, red_path)):
+            img.save(f'{path}.tmp', 'PNG')
+            os.replace(f'{path}.tmp', path)
+
+        with self.lock:
+            self.entries[key] = os.path.getsize(bw_path) + os.path.getsize(red_path)
+            self.evict()
+
+        return bw_image, red_image
+
+    def evict(self):
+        total = sum(self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            total -= size
+            for path in self.paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+class LayerCache:
+    # The album layers (everything drawn from the album art alone) an
+    # interface rendered for its last max_entries albums, keyed by the album
+    # art file. Songs from the same album then only need their text drawn.
+    # Layers are shared, so callers copy them before drawing on them.
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self.layers = OrderedDict()
+        self.lock = threading.Lock()
+
+    def clear(self):
+        with self.lock:
+            self.layers.clear()
+
+    def get(self, album_img, render):
+        stat = os.stat(album_img)
+        key = (album_img, stat.st_mtime, stat.st_size)
+        with self.lock:
+            layer = self.layers.get(key)
+            if layer is not None:
+                self.layers.move_to_end(key)
+                return layer
+
+        layer = render(album_img)
+        with self.lock:
+            self.layers[key] = layer
+            while len(self.layers) > self.max_entries:
+                self.layers.popitem(last=False)
+        return layer
 
 
 class MirroredInterface:
+    # Fields of the song info create draws
+    song_fields = ('song', 'album', 'artist', 'release_date')
+
     def __init__(self, dither_function, img_width, img_height):
         self.dither_function = dither_function
 
-        self.artist_font = 'fonts/Consolas.ttf'
-        self.artist_font_jp = 'fonts/KosugiMaru.ttf'
+        # Fallback chains, the first font that has every character is used
+        self.artist_fonts = ['fonts/Consolas.ttf', 'fonts/KosugiMaru.ttf']
         self.artist_font_sizes = [25]
 
-        self.album_font = "fonts/Consolas.ttf"
-        self.album_font_jp = "fonts/KosugiMaru.ttf"
+        self.album_fonts = ['fonts/Consolas.ttf', 'fonts/KosugiMaru.ttf']
         self.album_font_sizes = [25]
 
-        self.song_font = 'fonts/ChicagoFLF.ttf'
-        self.song_font_jp = 'fonts/KosugiMaru.ttf'
+        self.song_fonts = ['fonts/ChicagoFLF.ttf', 'fonts/KosugiMaru.ttf']
         self.song_font_sizes = [x for x in range(70, 44, -1)]
 
         self.img_width = img_width
         self.img_height = img_height
         self.album_height = img_height
 
-    def create(self, album_img, song_info):
-        bw_image = None
-        red_image = None
-
-        padding = 15
+        self.layers = LayerCache()
 
-        with Image.open(album_img) as album, Image.new('RGB', (self.img_width, self.img_height), color="white") as bw, Image.new('RGB', (self.img_width, self.img_height), color="white") as red:
+    def album_layer(self, album_img):
+        # The album art and its mirror images either side, dithered
+        with Image.open(album_img) as album, Image.new('RGB', (self.img_width, self.img_height), color="white") as bw:
             album = resize_image(album, self.album_height)
 
             album_x = int((bw.width / 2) - (album.width / 2))
@@ -113,8 +200,15 @@ class MirroredInterface:
 
             album_x = album_x + album.width
             bw.paste(album_flipped, (album_x, 0))
-            bw = self.dither_function(bw)
+            return self.dither_function(bw)
 
+    def create(self, album_img, song_info):
+        bw_image = None
+        red_image = None
+
+        padding = 15
+
+        with self.layers.get(album_img, self.album_layer).copy() as bw, Image.new('RGB', (self.img_width, self.img_height), color="white") as red:
             bw_draw = ImageDraw.Draw(bw)
             red_draw = ImageDraw.Draw(red)
 
@@ -123,10 +217,9 @@ class MirroredInterface:
             # Song title
 
             allowed_width = bw.width - (2 * padding)
-            song_font = get_font(bw_draw, self.song_font, self.song_font_jp,
-                                 self.song_font_sizes, song_info['song'], allowed_width)
-            song_text = cut_text(bw_draw, allowed_width,
-                                 song_font, song_info['song'])
+            song_font = get_font(self.song_fonts, self.song_font_sizes,
+                                 song_info['song'], allowed_width)
+            song_text = truncate(song_info['song'], song_font, allowed_width)
 
             song_size = song_font.getsize(song_text)
 
@@ -137,7 +230,7 @@ class MirroredInterface:
             shadow_offset = max(3, round(song_size[1] * (5 / 85)))
             album_padding = 10
 
-            album_font = get_font(bw_draw, self.album_font, self.album_font_jp, self.album_font_sizes,
+            album_font = get_font(self.album_fonts, self.album_font_sizes,
                                   song_info['album'], 99999)  # Don't scale, we have to add the year anyway
 
             year = song_info['release_date'][:4]
@@ -148,8 +241,7 @@ class MirroredInterface:
 
             allowed_album_width = red.width - \
                 (2 * padding) - year_text_size[0] - spacing_size[0]
-            album_text = cut_text(
-                bw_draw, allowed_album_width, album_font, song_info['album'])
+            album_text = truncate(song_info['album'], album_font, allowed_album_width)
 
             red_bar_bottom = album_pos[1] + year_text_size[1] + padding
 
@@ -157,11 +249,10 @@ class MirroredInterface:
 
             artist_mid_y = red_bar_bottom + ((bw.height - red_bar_bottom) // 2)
             artist_width = allowed_width
-            artist_font = get_font(bw_draw, self.artist_font, self.artist_font_jp,
-                                   self.artist_font_sizes, song_info['artist'], allowed_width)
+            artist_font = get_font(self.artist_fonts, self.artist_font_sizes,
+                                   song_info['artist'], allowed_width)
 
-            artist_text = cut_text(bw_draw, artist_width,
-                                   artist_font, song_info['artist'])
+            artist_text = truncate(song_info['artist'], artist_font, artist_width)
 
             artist_pos = (bw.width // 2, artist_mid_y)
 
@@ -202,6 +293,8 @@ class MirroredInterface:
 
 
 class RawAlbumInterface:
+    song_fields = ()
+
     def __init__(self, dither_function, img_width, img_height):
         self.dither_function = dither_function
 
@@ -209,13 +302,11 @@ class RawAlbumInterface:
         self.img_height = img_height
         self.album_height = img_height
 
-    def create(self, album_img, song_info):
-        bw_image = None
-        red_image = None
-
-        padding = 15
+        self.layers = LayerCache()
 
-        with Image.open(album_img) as album, Image.new('RGB', (self.img_width, self.img_height), color="white") as bw, Image.new('RGB', (self.img_width, self.img_height), color="white") as red:
+    def album_layer(self, album_img):
+        # The whole frame, there's no text on this one
+        with Image.open(album_img) as album, Image.new('RGB', (self.img_width, self.img_height), color="white") as bw:
             album = resize_image(album, self.album_height)
 
             album_x = int((bw.width / 2) - (album.width / 2))
@@ -227,62 +318,44 @@ class RawAlbumInterface:
             album_x = album_x + album.width
             bw.paste(album_flipped, (album_x, 0))
 
-            bw = self.dither_function(bw)
-
-            def is_red(pixel):
-                return pixel[0] > 200 and pixel[1] < 10 and pixel[2] < 10
-
-            def is_black(pixel):
-                return pixel[0] < 10 and pixel[1] < 10 and pixel[2] < 10
+            return split_red(self.dither_function(bw))
 
-            bw_image = bw.copy()
-            bw_pixels = bw_image.load()
-            for x in range(bw_image.width):
-                for y in range(bw_image.height):
-                    if is_red(bw_pixels[x, y]):
-                        bw_pixels[x, y] = (255, 255, 255)
-
-            red_image = bw.copy()
-            red_pixels = red_image.load()
-            for x in range(red_image.width):
-                for y in range(red_image.height):
-                    if is_black(red_pixels[x, y]):
-                        red_pixels[x, y] = (255, 255, 255)
-                    if is_red(red_pixels[x, y]):
-                        red_pixels[x, y] = (0, 0, 0)
-
-        return bw_image, red_image
+    def create(self, album_img, song_info):
+        bw_image, red_image = self.layers.get(album_img, self.album_layer)
+        return bw_image.copy(), red_image.copy()
 
 
 class BasicInterface:
+    song_fields = ('song', 'album', 'artist', 'release_date', 'track_number', 'total_tracks')
+
     def __init__(self, dither_function, img_width, img_height):
         self.dither_function = dither_function
 
-        self.artist_font = ImageFont.truetype('fonts/Consolas.ttf', size=25)
-        self.album_font = ImageFont.truetype('fonts/Consolas.ttf', size=25)
+        # Fallback chain for the album, year and artist, all at size 25
+        self.text_fonts = ['fonts/Consolas.ttf', 'fonts/KosugiMaru.ttf']
 
-        self.song_font = 'fonts/ChicagoFLF.ttf'
-        self.song_font_jp = 'fonts/KosugiMaru.ttf'
+        self.song_fonts = ['fonts/ChicagoFLF.ttf', 'fonts/KosugiMaru.ttf']
         self.song_font_sizes = [x for x in range(67, 39, -1)]
 
-        self.artist_font_jp = ImageFont.truetype(
-            'fonts/KosugiMaru.ttf', size=25)
-        self.album_font_jp = ImageFont.truetype(
-            'fonts/KosugiMaru.ttf', size=25)
-
         self.img_width = img_width
         self.img_height = img_height
         self.album_height = img_height - 52
 
+        self.layers = LayerCache()
+
+    def album_layer(self, album_img):
+        # The dithered album art in the top left corner
+        with Image.open(album_img) as img:
+            return self.dither_function(resize_image(img, self.album_height))
+
     def create(self, album_img, song_info):
         caption_text = f'{song_info["song"]}\n{song_info["album"]}\n{song_info["artist"]}'
 
         # Create display image
         bw_image = None
         red_image = None
-        with Image.open(album_img) as img, Image.new('RGB', (self.img_width, self.img_height), color="white") as bg, Image.new('RGB', (self.img_width, self.img_height), color="white") as red:
-            img = resize_image(img, self.album_height)
-            img = self.dither_function(img)
+        img = self.layers.get(album_img, self.album_layer)
+        with Image.new('RGB', (self.img_width, self.img_height), color="white") as bg, Image.new('RGB', (self.img_width, self.img_height), color="white") as red:
             bg.paste(img)
 
             bw_draw = ImageDraw.Draw(bg)
@@ -290,9 +363,7 @@ class BasicInterface:
 
             # Draw Album
 
-            album_font = self.album_font
-            if not font_supports_text('fonts/Consolas.ttf', song_info['album']):
-                album_font = self.album_font_jp
+            album_font = load_font(font_for_text(self.text_fonts, song_info['album']), 25)
 
             album_text_size = album_font.getsize(song_info['album'])
 
@@ -302,8 +373,7 @@ class BasicInterface:
             album_padding = 15
             album_max_width = self.img_width - \
                 (album_padding * 2) - (year_text_size[0] + album_padding)
-            album_text = cut_text(bw_draw, album_max_width,
-                                  album_font, song_info['album'])
+            album_text = truncate(song_info['album'], album_font, album_max_width)
 
             album_y = self.album_height + \
                 ((self.img_height - self.album_height) / 2)
@@ -320,10 +390,9 @@ class BasicInterface:
             max_title_width = int(0.9 * self.img_width)
             preferred_max_width = self.img_width - (img.width // 2)
 
-            song_font = get_font(bw_draw, self.song_font, self.song_font_jp,
-                                 self.song_font_sizes, song_info['song'], preferred_max_width)
-            song_text = cut_text(bw_draw, max_title_width,
-                                 song_font, song_info['song'])
+            song_font = get_font(self.song_fonts, self.song_font_sizes,
+                                 song_info['song'], preferred_max_width)
+            song_text = truncate(song_info['song'], song_font, max_title_width)
 
             song_size = song_font.getsize(song_text)
             song_pos = (self.img_width - album_padding -
@@ -354,15 +423,12 @@ class BasicInterface:
                           fill=(255, 255, 255, 255))
 
             # Draw Artist
-            artist_font = self.artist_font
-            if not font_supports_text('fonts/Consolas.ttf', song_info['artist']):
-                artist_font = self.artist_font_jp
+            artist_font = load_font(font_for_text(self.text_fonts, song_info['artist']), 25)
 
             artist_pos = (img.width + album_padding,
                           int(song_rect_box[1][1] + album_padding))
             artist_max_width = self.img_width - img.width - (2 * album_padding)
-            artist_text = line_wrap(
-                bw_draw, artist_max_width, artist_font, song_info['artist'])
+            artist_text = wrap(song_info['artist'], artist_font, artist_max_width)
             bw_draw.multiline_text(artist_pos, artist_text, font=artist_font, fill=(
                 0, 0, 0, 255), align="left", spacing=10)
 
@@ -0,0 +1,401 @@
+import hashlib
+import os
+import os.path
+import random
+import struct
+import subprocess
+import threading
+
+from collections import OrderedDict
+
+from Log import LogLevel, LogCategory, log
+
+from PIL import Image
+
+BLACK = (0, 0, 0)
+WHITE = (255, 255, 255)
+RED = (255, 0, 0)
+
+BW_PALETTE = [BLACK, WHITE]
+RED_PALETTE = [BLACK, WHITE, RED]
+
+# How close (Oklab) a cluster has to be to the third colour to be dithered
+# with it
+MATCH_THRESHOLD = 0.15
+
+
+def srgb_to_linear(c):
+    if c <= 0.04045:
+        return c / 12.92
+    return ((c + 0.055) / 1.055) ** 2.4
+
+
+def linear_srgb_to_oklab(r, g, b):
+    l = (0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b) ** (1 / 3)
+    m = (0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b) ** (1 / 3)
+    s = (0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b) ** (1 / 3)
+    return (0.2104542553 * l + 0.7936177850 * m - 0.0040720468 * s,
+            1.9779984951 * l - 2.4285922050 * m + 0.4505937099 * s,
+            0.0259040371 * l + 0.7827717662 * m - 0.8086757660 * s)
+
+
+def srgb_to_oklab(colour):
+    return linear_srgb_to_oklab(*[srgb_to_linear(c / 255) for c in colour])
+
+
+def oklab_distance(c1, c2):
+    return ((c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[2] - c2[2]) ** 2) ** 0.5
+
+
+def parse_colour(text):
+    # "RRGGBB" -> (r, g, b)
+    if len(text) != 6:
+        raise ValueError(f"Incorrect colour format: {text}, please specify colour as RRGGBB")
+    return tuple(int(text[i:i + 2], 16) for i in (0, 2, 4))
+
+
+# 8 bit sRGB -> 8 bit linear light, for every channel of an RGB image
+_TO_LINEAR = [round(srgb_to_linear(v / 255) * 255) for v in range(256)] * 3
+
+
+def _palette_image(colours):
+    palette = Image.new('P', (1, 1))
+    flat = [channel for colour in colours for channel in colour]
+    palette.putpalette(flat + list(colours[0]) * (256 - len(colours)))
+    return palette
+
+
+def error_diffuse(img, palette):
+    # Floyd-Steinberg to the nearest palette colour, with the error spread in
+    # linear light so the dithered image keeps the brightness of the original.
+    # PIL's quantizer picks the nearest colour in linear RGB where the dither
+    # program measures it in Oklab, so the pattern (not the tone) differs a
+    # little from its output.
+    linear = img.convert('RGB').point(_TO_LINEAR)
+    linear_palette = [tuple(_TO_LINEAR[c] for c in colour) for colour in palette]
+
+    dithered = linear.quantize(palette=_palette_image(linear_palette),
+                               dither=Image.FLOYDSTEINBERG)
+    dithered.putpalette(_palette_image(palette).getpalette())
+    return dithered.convert('RGB')
+
+
+def luma(img):
+    # Rec. 709 luma, the same grey the dither tool dithers in black and white
+    return img.convert('L', (0.2126, 0.7152, 0.0722, 0)).convert('RGB')
+
+
+def cluster(colours, num_clusters, max_iterations, seed_colour=None, rng=random):
+    # k-means in Oklab over weighted colours [(count, oklab)], k-means++
+    # initialisation with seed_colour as the first centre if given. Returns
+    # the centres and the index of the centre each colour ended up in.
+    unique = [colour for _, colour in colours]
+    centres = []
+    if seed_colour is not None:
+        centres.append(seed_colour)
+    if len(unique) <= num_clusters - len(centres):
+        centres += unique
+    else:
+        centres.append(rng.choice(unique))
+        while len(centres) < num_clusters:
+            weights = [min(oklab_distance(colour, centre) for centre in centres) for colour in unique]
+            centres.append(rng.choices(unique, weights)[0])
+
+    assignment = []
+    scores = None
+    for _ in range(max_iterations):
+        assignment = [min(range(len(centres)), key=lambda i: oklab_distance(colour, centres[i]))
+                      for colour in unique]
+
+        totals = [[0, 0.0, 0.0, 0.0] for _ in centres]
+        for (count, (l, a, b)), i in zip(colours, assignment):
+            total = totals[i]
+            total[0] += count
+            total[1] += l * count
+            total[2] += a * count
+            total[3] += b * count
+        # An empty cluster collapses to 0, like the dither tool's average
+        centres = [(l / n, a / n, b / n) if n else (0.0, 0.0, 0.0) for n, l, a, b in totals]
+
+        new_scores = [0.0] * len(centres)
+        for (count, colour), i in zip(colours, assignment):
+            new_scores[i] += oklab_distance(colour, centres[i]) * count
+        new_scores = [score / n if n else 0.0 for score, (n, _, _, _) in zip(new_scores, totals)]
+
+        converged = scores is not None and all(abs(s1 - s2) < 1e-5 for s1, s2 in zip(scores, new_scores))
+        scores = new_scores
+        if converged:
+            break
+
+    return centres, assignment
+
+
+def match_colour(img, colour, num_clusters, max_iterations, rng=random):
+    # Mask ("L", 255 = match) of the pixels whose colour cluster is close to
+    # colour, None if no cluster is. The clustering runs on a 256 colour
+    # version of the image, which is plenty for 5 clusters and keeps it fast.
+    reduced = img.quantize(256, dither=Image.NONE)
+    palette = reduced.getpalette()
+    counts = reduced.getcolors(256)
+    colours = [(count, srgb_to_oklab(palette[index * 3:index * 3 + 3])) for count, index in counts]
+
+    target = srgb_to_oklab(colour)
+    centres, assignment = cluster(colours, num_clusters, max_iterations, target, rng)
+    matching = [oklab_distance(centre, target) < MATCH_THRESHOLD for centre in centres]
+    if not any(matching):
+        return None
+
+    table = [0] * 256
+    for (_, index), i in zip(counts, assignment):
+        table[index] = 255 if matching[i] else 0
+    return Image.frombytes('L', reduced.size, reduced.tobytes()).point(table)
+
+
+def dither_image(img, num_clusters=5, max_iterations=50, third_colour=None, seed=0):
+    # An approximation of `dither -n <num_clusters> -m <max_iterations> dither
+    # [-c <third_colour>]`: a black and white dither of the image, except that
+    # when one of its main colours is close to third_colour those areas are
+    # dithered with black, white and red instead. The clustering follows the
+    # dither program, the error diffusion doesn't quite (see error_diffuse).
+    img = img.convert('RGB')
+    if third_colour is not None:
+        mask = match_colour(img, parse_colour(third_colour), num_clusters,
+                            max_iterations, random.Random(seed))
+        if mask is not None:
+            black = Image.new('RGB', img.size, BLACK)
+            red = error_diffuse(Image.composite(img, black, mask), RED_PALETTE)
+            bw = error_diffuse(luma(Image.composite(black, img, mask)), BW_PALETTE)
+            return Image.composite(red, bw, mask)
+
+    return error_diffuse(luma(img), BW_PALETTE)
+
+
+class DitherCache:
+    # Dithered images keyed by a hash of the input pixels and the dither
+    # settings, as PNGs in folder with the most recently used max_entries also
+    # kept in memory. The same album art gets dithered for every track on the
+    # album and every interface that pastes it the same way, so most dithers
+    # end up being a lookup. Once the folder grows past max_bytes the least
+    # recently used dithers are deleted.
+    def __init__(self, folder, max_bytes, max_entries=16):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.images = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+
+        # key -> bytes on disk, least recently used first
+        self.entries = OrderedDict()
+        dithers = [f for f in os.listdir(folder) if f.endswith('.png')]
+        dithers.sort(key=lambda f: os.path.getmtime(os.path.join(folder, f)))
+        for dither in dithers:
+            self.entries[dither[:-len('.png')]] = os.path.getsize(os.path.join(folder, dither))
+
+    def key(self, img, settings):
+        digest = hashlib.sha1()
+        digest.update(repr((img.mode, img.size, settings)).encode())
+        digest.update(img.tobytes())
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.folder, f'{key}.png')
+
+    def get(self, key):
+        with self.lock:
+            found = key in self.entries
+            if found:
+                self.entries.move_to_end(key)
+            img = self.images.get(key)
+            if img is not None:
+                self.images.move_to_end(key)
+                return img
+
+        if not found:
+            return None
+        path = self.path(key)
+        try:
+            with Image.open(path) as f:
+                img = f.convert('RGB')
+            # mtime is the LRU order when the cache is reloaded
+            os.utime(path)
+        except OSError:
+            with self.lock:
+                self.entries.pop(key, None)
+            return None
+        self.remember(key, img)
+        return img
+
+    def put(self, key, img):
+        self.remember(key, img)
+        # Written under a temporary name first so a half written file is
+        # never picked up
+        path = self.path(key)
+        img.save(f'{path}.tmp', 'PNG')
+        os.replace(f'{path}.tmp', path)
+
+        with self.lock:
+            self.entries[key] = os.path.getsize(path)
+            self.entries.move_to_end(key)
+            self.evict()
+
+    def evict(self):
+        total = sum(self.entries.values())
+        while total > self.max_bytes and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            total -= size
+            path = self.path(key)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def remember(self, key, img):
+        with self.lock:
+            self.images[key] = img
+            self.images.move_to_end(key)
+            while len(self.images) > self.max_entries:
+                self.images.popitem(last=False)
+
+    def wrap(self, dither, *settings):
+        # dither, but looked up in the cache first. Callers draw on the result
+        # so they always get their own copy.
+        def cached_dither(img):
+            img = img.convert('RGB')
+            key = self.key(img, settings)
+            result = self.get(key)
+            if result is None:
+                self.misses += 1
+                result = dither(img).convert('RGB')
+                self.put(key, result)
+            else:
+                self.hits += 1
+                log(LogLevel.INFO, LogCategory.DITHERING, "Dithered album art found in cache")
+            return result.copy()
+
+        cached_dither.settings = settings
+        return cached_dither
+
+
+def dither_engine(num_clusters=5, max_iterations=50, third_colour='E42C35', cache=None):
+    # In process replacement for dither_function, no files or processes. The
+    # output is close to the dither program's but not identical.
+    def dither(img):
+        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
+        return dither_image(img, num_clusters, max_iterations)
+
+    def dither_red(img):
+        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
+        return dither_image(img, num_clusters, max_iterations, third_colour)
+
+    # What a cached dither or render made with these functions depends on
+    dither.settings = ('engine', num_clusters, max_iterations)
+    dither_red.settings = dither.settings + (third_colour,)
+
+    if cache is not None:
+        dither = cache.wrap(dither, *dither.settings)
+        dither_red = cache.wrap(dither_red, *dither_red.settings)
+    return dither, dither_red
+
+
+class DitherWorker:
+    # One long running `dither - serve` process, fed raw RGB frames over its
+    # stdin and answering on its stdout, so there's no PNG encoding and no
+    # temp files. Jobs are serialised, a crashed worker is restarted and a
+    # job that takes longer than timeout seconds gets the worker killed.
+
+    # width, height, use third colour, third colour
+    REQUEST = struct.Struct('>II?3s')
+    # width, height
+    RESPONSE = struct.Struct('>II')
+
+    def __init__(self, dither_path, num_clusters=5, max_iterations=50, timeout=60):
+        self.args = [dither_path, '-', '-n', str(num_clusters), '-m', str(max_iterations), 'serve']
+        self.timeout = timeout
+        self.process = None
+        self.timed_out = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        log(LogLevel.INFO, LogCategory.DITHERING, "Starting dither worker")
+        self.process = subprocess.Popen(self.args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.wait()
+        try:
+            # Flushes anything still buffered, into a pipe nobody reads anymore
+            self.process.stdin.close()
+        except OSError:
+            pass
+        self.process.stdout.close()
+        self.process = None
+
+    def dither(self, img, third_colour=None):
+        img = img.convert('RGB')
+        colour = bytes(parse_colour(third_colour)) if third_colour is not None else bytes(3)
+        request = self.REQUEST.pack(img.width, img.height, third_colour is not None, colour) + img.tobytes()
+
+        with self.lock:
+            # A worker that died between jobs, or on this one, gets one restart
+            for attempt in range(2):
+                if self.process is None or self.process.poll() is not None:
+                    self.stop()
+                    self.start()
+                try:
+                    return self._run(request)
+                except (OSError, EOFError) as e:
+                    self.stop()
+                    if self.timed_out:
+                        log(LogLevel.ERROR, LogCategory.DITHERING, f"Dithering timed out after {self.timeout}s")
+                        raise TimeoutError(f"Dithering took longer than {self.timeout}s") from e
+                    log(LogLevel.ERROR, LogCategory.DITHERING, f"Dither worker died: {e}")
+                    if attempt:
+                        raise
+
+    def _run(self, request):
+        self.timed_out = False
+        process = self.process
+
+        def kill():
+            self.timed_out = True
+            process.kill()
+
+        watchdog = threading.Timer(self.timeout, kill)
+        watchdog.start()
+        try:
+            process.stdin.write(request)
+            process.stdin.flush()
+            width, height = self.RESPONSE.unpack(self._read(self.RESPONSE.size))
+            pixels = self._read(width * height * 3)
+        finally:
+            watchdog.cancel()
+        return Image.frombytes('RGB', (width, height), pixels)
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) < size:
+            raise EOFError("Dither worker closed its output")
+        return data
+
+
+def dither_function(dither_path, num_clusters=5, max_iterations=50, third_colour='E42C35', cache=None):
+    worker = DitherWorker(dither_path, num_clusters, max_iterations)
+
+    def dither(img):
+        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
+        return worker.dither(img)
+
+    def dither_red(img):
+        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
+        return worker.dither(img, third_colour)
+
+    dither.settings = ('program', num_clusters, max_iterations)
+    dither_red.settings = dither.settings + (third_colour,)
+
+    if cache is not None:
+        dither = cache.wrap(dither, *dither.settings)
+        dither_red = cache.wrap(dither_red, *dither_red.settings)
+    return dither, dither_red
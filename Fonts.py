@@ -0,0 +1,107 @@
+import json
+import os
+import os.path
+import threading
+
+from functools import lru_cache
+
+from fontTools.ttLib import TTFont
+from PIL import ImageFont
+
+# Codepoints each font has glyphs for, kept between runs so fontTools only
+# has to open a font again when the file changes
+COVERAGE_CACHE = 'fonts/.coverage.json'
+
+_coverage = {}
+_coverage_lock = threading.Lock()
+
+
+def _to_ranges(codepoints):
+    ranges = []
+    for codepoint in sorted(codepoints):
+        if ranges and ranges[-1][1] == codepoint - 1:
+            ranges[-1][1] = codepoint
+        else:
+            ranges.append([codepoint, codepoint])
+    return ranges
+
+
+def _from_ranges(ranges):
+    return frozenset(codepoint for start, end in ranges for codepoint in range(start, end + 1))
+
+
+def _load_cache():
+    try:
+        with open(COVERAGE_CACHE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_cache(cache):
+    try:
+        with open(f'{COVERAGE_CACHE}.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(f'{COVERAGE_CACHE}.tmp', COVERAGE_CACHE)
+    except OSError:
+        pass
+
+
+def font_coverage(font):
+    # Set of codepoints the font at path font has glyphs for, from memory, the
+    # coverage cache (if the font's mtime and size still match) or the font's
+    # cmap tables, in that order
+    coverage = _coverage.get(font)
+    if coverage is not None:
+        return coverage
+
+    with _coverage_lock:
+        stat = os.stat(font)
+        cache = _load_cache()
+        entry = cache.get(font)
+        if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            coverage = _from_ranges(entry['ranges'])
+        else:
+            with TTFont(font, lazy=True) as f:
+                coverage = frozenset(codepoint for table in f['cmap'].tables for codepoint in table.cmap)
+            cache[font] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'ranges': _to_ranges(coverage)}
+            _save_cache(cache)
+
+        _coverage[font] = coverage
+        return coverage
+
+
+def font_supports_text(font, text):
+    return font_coverage(font).issuperset(map(ord, text))
+
+
+def font_for_text(fonts, text):
+    # First font in the fallback chain fonts that has every character in text,
+    # the last one if none of them do
+    for font in fonts[:-1]:
+        if font_supports_text(font, text):
+            return font
+    return fonts[-1]
+
+
+@lru_cache(maxsize=None)
+def load_font(font, size):
+    # ImageFont.truetype(font, size=size), but each face is only loaded once
+    return ImageFont.truetype(font, size=size)
+
+
+@lru_cache(maxsize=1024)
+def fit_font(fonts, sizes, text, allowed_width):
+    # text in the font from the fallback chain fonts (a tuple) at the largest
+    # of sizes (a tuple, largest first) it fits into allowed_width at, or the
+    # smallest if it never fits. Text only gets wider as the size goes up, so
+    # the size is binary searched.
+    font = font_for_text(fonts, text)
+    low, high = 0, len(sizes) - 1
+    while low < high:
+        middle = (low + high) // 2
+        if load_font(font, sizes[middle]).getlength(text) <= allowed_width:
+            high = middle
+        else:
+            low = middle + 1
+    return load_font(font, sizes[low])
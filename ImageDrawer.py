@@ -1,10 +1,25 @@
 
 from Log import log, LogCategory, LogLevel
+from collections import deque
+from concurrent.futures import Future
+from config import eink_busy_timeout_ms, eink_full_refresh_every, eink_panel
 from PIL import Image
 from sys import argv, platform
+import hashlib
+import importlib
+import threading
+
+
+# 255 where the red plane has ink (a red channel of 0)
+_RED_INK_TABLE = [255] + [0] * 255
 
 
 class BasicDrawer:
+    # Shows frames on screen, or with output (a path or a file object) saves
+    # them there as PNGs instead
+    def __init__(self, output=None):
+        self.output = output
+
     def __enter__(self):
         return self
 
@@ -19,56 +34,322 @@ class BasicDrawer:
 
     def draw(self, img, red):
         img = img.convert('RGB')
-        red = red.convert('RGB')
+        red_ink = red.convert('RGB').getchannel('R').point(_RED_INK_TABLE)
+        img.paste((255, 0, 0), mask=red_ink)
 
-        red_pixels = red.load()
-        black_pixels = img.load()
-        for x in range(red.width):
-            for y in range(red.height):
-                if red_pixels[x, y][0] <= 0:
-                    black_pixels[x, y] = (255, 0, 0)
-        img.show()
+        if self.output is None:
+            img.show()
+        else:
+            img.save(self.output, 'PNG')
+        return img
 
     def clear(self):
         pass
 
 
 if not platform == "win32":
-    from lib.waveshare_epd import epd5in83b_V2 as waveshare
+    from lib.waveshare_epd import epdbuffer, epdconfig
+
+
+class Panel:
+    # Adapts a waveshare EPD to what EinkDrawer needs. This is the shape most
+    # of the drivers (epd5in83b_V2 included) share: a black and a red plane,
+    # init/Clear/sleep without arguments. The drivers with a partial refresh
+    # disagree on names and arguments, so they get a subclass each.
+    supports_partial = False
+
+    def __init__(self, module):
+        self.epd = module.EPD()
+
+    def init(self):
+        self.epd.init()
+
+    def clear(self):
+        self.epd.Clear()
+
+    def sleep(self):
+        self.epd.sleep()
+
+    def exit(self):
+        self.epd.Dev_exit()
+
+    def pack(self, bw, red):
+        return self.epd.getbuffer(bw), self.epd.getbuffer(red)
+
+    def display(self, planes):
+        self.epd.display(*planes)
+
+
+class MonoPanel(Panel):
+    # Black and white only, red is drawn as black
+    def pack(self, bw, red):
+        return epdbuffer.merge_planes(self.epd.getbuffer(bw), self.epd.getbuffer(red)),
+
+
+class Epd4in2Panel(MonoPanel):
+    supports_partial = True
+
+    def display_partial(self, box, previous, planes):
+        x_start, y_start, x_end, y_end = box
+        self.epd.EPD_4IN2_PartialDisplay(x_start, y_start, x_end, y_end, planes[0])
+
+
+class Epd2in13V2Panel(MonoPanel):
+    # No windowed update, the partial waveform is sent for the whole frame.
+    # Switching between full and partial needs a re-init.
+    supports_partial = True
+
+    def init(self):
+        self.epd.init(self.epd.FULL_UPDATE)
+        self.partial_mode = False
+
+    def clear(self):
+        if self.partial_mode:
+            self.init()
+        self.epd.Clear(0xFF)
+
+    def display(self, planes):
+        if self.partial_mode:
+            self.init()
+        self.epd.display(planes[0])
+
+    def display_partial(self, box, previous, planes):
+        if not self.partial_mode:
+            self.epd.init(self.epd.PART_UPDATE)
+            self.partial_mode = True
+        self.epd.displayPartial(planes[0])
+
+
+class Epd2in9dPanel(MonoPanel):
+    # Whole frame partial refresh, display() switches back to the full LUT
+    supports_partial = True
+
+    def clear(self):
+        self.epd.Clear(0xFF)
+
+    def display(self, planes):
+        self.epd.display(planes[0])
+
+    def display_partial(self, box, previous, planes):
+        self.epd.DisplayPartial(planes[0])
+
+
+class Epd1in02Panel(MonoPanel):
+    # Whole frame partial refresh from the old and new frames, switching
+    # between full and partial needs a re-init
+    supports_partial = True
+
+    def init(self):
+        self.epd.Init()
+        self.partial_mode = False
+
+    def clear(self):
+        if self.partial_mode:
+            self.init()
+        self.epd.Clear()
+
+    def sleep(self):
+        self.epd.Sleep()
+
+    def display(self, planes):
+        if self.partial_mode:
+            self.init()
+        self.epd.Display(planes[0])
+
+    def display_partial(self, box, previous, planes):
+        if not self.partial_mode:
+            self.epd.Partial_Init()
+            self.partial_mode = True
+        self.epd.DisplayPartial(previous[0], planes[0])
+
+
+PANELS = {
+    "epd4in2": Epd4in2Panel,
+    "epd2in13_V2": Epd2in13V2Panel,
+    "epd2in9d": Epd2in9dPanel,
+    "epd1in02": Epd1in02Panel,
+}
+
+
+def open_panel(name):
+    module = importlib.import_module(f"lib.waveshare_epd.{name}")
+    return PANELS.get(name, Panel)(module)
+
+
+class PanelWorker:
+    # Runs panel operations one at a time on a single thread, which is then
+    # the only thing touching SPI/GPIO. submit() returns a Future for the
+    # operation's result.
+    #
+    # Work that is still queued gets coalesced: a new draw cancels any draw
+    # that hasn't started yet (only the newest frame is worth a refresh), and
+    # a wakeup straight after a queued sleep cancels the sleep.
+    def __init__(self):
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name="eink", daemon=True)
+        self.thread.start()
+
+    def submit(self, kind, function, *args):
+        future = Future()
+        with self.condition:
+            if kind == "draw":
+                for stale in [op for op in self.pending if op[0] == "draw"]:
+                    log(LogLevel.INFO, LogCategory.EINK, "Dropping stale frame")
+                    self.pending.remove(stale)
+                    stale[1].cancel()
+            elif kind == "wakeup" and self.pending and self.pending[-1][0] == "sleep":
+                self.pending.pop()[1].cancel()
+                future.set_result(None)
+                return future
+
+            self.pending.append((kind, future, function, args))
+            self.condition.notify()
+        return future
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                kind, future, function, args = self.pending.popleft()
+
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(function(*args))
+            except Exception as e:
+                log(LogLevel.ERROR, LogCategory.EINK, f"Display {kind} failed: {e}")
+                future.set_exception(e)
+
+    def stop(self):
+        # Finishes everything already queued before returning
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        self.thread.join()
 
 
 class EinkDrawer:
+    # With background=True every panel operation is queued to a PanelWorker
+    # and the methods return a Future instead of blocking for the refresh.
+    #
+    # draw wakes a sleeping panel itself and puts it back to sleep after, but
+    # only if the frame actually changed.
+    def __init__(self, background=False):
+        self.background = background
+        self.worker = None
+        self.awake = False
+        # Digest and packed planes of the frame currently on the panel, None
+        # when unknown
+        self.last_frame = None
+        self.last_planes = None
+        self.refreshes_saved = 0
+        self.partial_refreshes = 0
+
     def __enter__(self):
         log(LogLevel.INFO, LogCategory.EINK, "Initializing display")
-        self.epd = waveshare.EPD()
-        self.epd.init()
-        self.epd.Clear()
+        epdconfig.busy_timeout_ms = eink_busy_timeout_ms
+        self.panel = open_panel(eink_panel)
+        if self.background:
+            self.worker = PanelWorker()
+        self.run("init", self._init)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         log(LogLevel.INFO, LogCategory.EINK, "Going to sleep")
-        self.epd.sleep()
-        self.epd.Dev_exit()
+        self.run("exit", self._exit)
+        if self.worker is not None:
+            self.worker.stop()
+            self.worker = None
+
+    def run(self, kind, function, *args):
+        if self.worker is None:
+            return function(*args)
+        return self.worker.submit(kind, function, *args)
 
     def wakeup(self):
-        log(LogLevel.INFO, LogCategory.EINK, "Waking up display")
-        self.epd.init()
+        return self.run("wakeup", self._wakeup)
 
     def sleep(self):
-        log(LogLevel.INFO, LogCategory.EINK, "Putting display to sleep")
-        self.epd.sleep()
+        return self.run("sleep", self._sleep)
 
     def draw(self, bw, red):
+        return self.run("draw", self._draw, bw, red)
+
+    def clear(self):
+        return self.run("clear", self._clear)
+
+    def _init(self):
+        self.panel.init()
+        self.awake = True
+        self._clear()
+        self._sleep()
+
+    def _exit(self):
+        self.panel.sleep()
+        self.panel.exit()
+        self.awake = False
+
+    def _wakeup(self):
+        log(LogLevel.INFO, LogCategory.EINK, "Waking up display")
+        self.panel.init()
+        self.awake = True
+
+    def _sleep(self):
+        log(LogLevel.INFO, LogCategory.EINK, "Putting display to sleep")
+        self.panel.sleep()
+        self.awake = False
+
+    def _draw(self, bw, red):
         one_bit_bw = bw.convert("1", dither=Image.NONE)
         one_bit_red = red.convert("1", dither=Image.NONE)
 
-        log(LogLevel.INFO, LogCategory.EINK, "Drawing to display")
-        self.epd.display(self.epd.getbuffer(one_bit_bw),
-                         self.epd.getbuffer(one_bit_red))
+        planes = self.panel.pack(one_bit_bw, one_bit_red)
 
-    def clear(self):
+        frame = hashlib.sha1(b''.join(bytes(plane) for plane in planes)).digest()
+        if frame == self.last_frame:
+            self.refreshes_saved += 1
+            log(LogLevel.INFO, LogCategory.EINK,
+                f"Frame unchanged, skipping refresh ({self.refreshes_saved} saved)")
+            return
+
+        woken = not self.awake
+        if woken:
+            self._wakeup()
+
+        previous = self.last_planes
+        box = None
+        if (self.panel.supports_partial and previous is not None
+                and self.partial_refreshes < eink_full_refresh_every):
+            box = epdbuffer.dirty_box(previous[0], planes[0],
+                                      self.panel.epd.width, self.panel.epd.height)
+
+        # Unknown until the refresh actually completes
+        self.last_frame = None
+        self.last_planes = None
+        if box is None:
+            log(LogLevel.INFO, LogCategory.EINK, "Drawing to display")
+            self.panel.display(planes)
+            self.partial_refreshes = 0
+        else:
+            log(LogLevel.INFO, LogCategory.EINK, f"Partially redrawing {box}")
+            self.panel.display_partial(box, previous, planes)
+            self.partial_refreshes += 1
+        self.last_frame = frame
+        self.last_planes = planes
+
+        if woken:
+            self._sleep()
+
+    def _clear(self):
         log(LogLevel.INFO, LogCategory.EINK, "Clearing display")
-        self.epd.Clear()
+        self.panel.clear()
+        self.last_frame = None
+        self.last_planes = None
 
 
 if __name__ == "__main__":
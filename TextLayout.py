@@ -0,0 +1,74 @@
+import unicodedata
+
+from bisect import bisect_right
+from functools import lru_cache
+from itertools import accumulate
+
+ELLIPSIS = "..."
+
+
+@lru_cache(maxsize=4096)
+def text_width(font, text):
+    return font.getlength(text)
+
+
+def _grapheme_start(text, i):
+    # Step back so a cut at i doesn't split a character from its combining
+    # marks
+    while 0 < i < len(text) and unicodedata.combining(text[i]):
+        i -= 1
+    return i
+
+
+def truncate(text, font, max_width):
+    # text if it fits into max_width, otherwise the longest start of it that
+    # still fits with "..." on the end. The cut is first estimated from the
+    # summed widths of the characters, then corrected by measuring the actual
+    # strings since kerning makes them a little narrower or wider.
+    if text_width(font, text) <= max_width:
+        return text
+
+    def fits(i):
+        return text_width(font, text[:i].rstrip() + ELLIPSIS) <= max_width
+
+    prefix_widths = list(accumulate(text_width(font, c) for c in text))
+    i = bisect_right(prefix_widths, max_width - text_width(font, ELLIPSIS))
+    while i > 0 and not fits(i):
+        i -= 1
+    while i < len(text) and fits(i + 1):
+        i += 1
+
+    return text[:_grapheme_start(text, i)].rstrip() + ELLIPSIS
+
+
+def wrap(text, font, max_width):
+    # Greedy word wrap into lines no wider than max_width, joined with "\n".
+    # Every word is measured once and lines are built from the running sum,
+    # only a line that comes close to max_width gets measured as a whole to
+    # account for kerning. Words that don't fit on a line of their own are
+    # truncated.
+    space = text_width(font, " ")
+    lines = []
+    line = []
+    line_width = 0
+
+    for word in text.split(" "):
+        word_width = text_width(font, word)
+        if word_width > max_width:
+            word = truncate(word, font, max_width)
+            word_width = text_width(font, word)
+
+        width = line_width + space + word_width
+        if line and (width > max_width or
+                     (width > max_width - space and text_width(font, " ".join(line + [word])) > max_width)):
+            lines.append(" ".join(line))
+            line = []
+
+        if line:
+            line_width += space + word_width
+        else:
+            line_width = word_width
+        line.append(word)
+
+    lines.append(" ".join(line))
+    return "\n".join(lines)
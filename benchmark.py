@@ -0,0 +1,158 @@
+import argparse
+import os
+import os.path
+import random
+import resource
+import time
+import tracemalloc
+
+from config import dither_cache_max_bytes, eink_panel, img_height, img_width
+
+# The display stage runs against the simulated SPI/GPIO backend, so this has
+# to be set before anything imports epdconfig
+os.environ.setdefault('EPD_SIMULATE', eink_panel)
+
+from AlbumDisplay import BasicInterface, MirroredInterface, RawAlbumInterface
+from Dither import DitherCache, dither_engine, dither_function
+from ImageDrawer import open_panel
+from lib.waveshare_epd import epdconfig
+
+from PIL import Image
+
+# Song info in the shape spotifyApi.current_song() returns, the Japanese
+# titles force the KosugiMaru fallback fonts
+SONGS = [
+    {'artist': 'BADBADNOTGOOD', 'album': 'IV', 'release_date': '2016-07-08',
+     'song': 'Time Moves Slow', 'track_number': 5, 'total_tracks': 11},
+    {'artist': 'The Beatles', 'album': 'Abbey Road (Remastered)', 'release_date': '1969-09-26',
+     'song': 'Here Comes The Sun - Remastered 2009', 'track_number': 7, 'total_tracks': 17},
+    {'artist': 'YOASOBI', 'album': 'THE BOOK', 'release_date': '2021-01-06',
+     'song': '夜に駆ける', 'track_number': 2, 'total_tracks': 10},
+    {'artist': '宇多田ヒカル', 'album': '初恋', 'release_date': '2018-06-27',
+     'song': '誓い', 'track_number': 1, 'total_tracks': 12},
+    {'artist': 'Godspeed You! Black Emperor', 'album': 'Lift Your Skinny Fists Like Antennas to Heaven',
+     'release_date': '2000-10-09', 'song': 'Storm', 'track_number': 1, 'total_tracks': 4},
+]
+
+DEFAULT_CORPUS = ['photos', 'dither_rust/img']
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+
+def find_covers(folders):
+    covers = []
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            covers += [os.path.join(root, f) for f in sorted(files)
+                       if f.lower().endswith(IMAGE_EXTENSIONS)]
+    return covers
+
+
+def percentile(samples, p):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Stages:
+    # Wall time in ms per stage and, with trace_memory, the peak Python heap
+    # (tracemalloc) seen during it. Tracing slows the Python-heavy stages
+    # down noticeably, so it's off unless asked for.
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.times = {}
+        self.peaks = {}
+
+    def run(self, stage, function, *args):
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.times.setdefault(stage, []).append(elapsed)
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                self.peaks[stage] = max(self.peaks.get(stage, 0), peak)
+
+    def add(self, stage, elapsed):
+        self.times.setdefault(stage, []).append(elapsed)
+
+    def report(self):
+        print(f"{'stage':<40}{'n':>5}{'p50':>10}{'p90':>10}{'p99':>10}{'max':>10}{'peak MiB':>10}")
+        for stage, samples in self.times.items():
+            peak = self.peaks.get(stage)
+            peak = f"{peak / 2 ** 20:.1f}" if peak is not None else "-"
+            print(f"{stage:<40}{len(samples):>5}"
+                  f"{percentile(samples, 50):>10.1f}{percentile(samples, 90):>10.1f}"
+                  f"{percentile(samples, 99):>10.1f}{max(samples):>10.1f}{peak:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time album art -> interface -> framebuffer -> display for every interface")
+    parser.add_argument('covers', nargs='*', default=DEFAULT_CORPUS,
+                        help="Folders of album covers (default: %(default)s)")
+    parser.add_argument('--dither', help="Path to the dither program, in process dithering if not given")
+    parser.add_argument('--dither-cache', help="Folder to cache dithered images in, no caching if not given")
+    parser.add_argument('--runs', type=int, default=3, help="Passes over the corpus")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Record peak Python heap per stage (slows the run down)")
+    args = parser.parse_args()
+
+    covers = find_covers(args.covers)
+    if not covers:
+        print("No album covers found")
+        exit(1)
+
+    cache = DitherCache(args.dither_cache, dither_cache_max_bytes) if args.dither_cache else None
+    if args.dither:
+        dither, dither_red = dither_function(args.dither, cache=cache)
+    else:
+        dither, dither_red = dither_engine(cache=cache)
+
+    interfaces = [
+        BasicInterface(dither, img_width, img_height),
+        MirroredInterface(dither, img_width, img_height),
+        RawAlbumInterface(dither_red, img_width, img_height)
+    ]
+
+    panel = open_panel(eink_panel)
+    panel.init()
+
+    stages = Stages(args.trace_memory)
+    rng = random.Random(args.seed)
+    for _ in range(args.runs):
+        for cover in covers:
+            song = dict(rng.choice(SONGS))
+            for interface in interfaces:
+                name = type(interface).__name__
+                start = time.perf_counter()
+
+                # Every cover is timed cold, the layer cache would otherwise
+                # turn every run after the first into a text-only redraw
+                interface.layers.clear()
+                bw, red = stages.run(f"create {name}", interface.create, cover, song)
+                planes = stages.run("pack", panel.pack,
+                                    bw.convert("1", dither=Image.NONE),
+                                    red.convert("1", dither=Image.NONE))
+
+                epdconfig.reset_stats()
+                stages.run("display (transfer)", panel.display, planes)
+                stages.add("display (simulated panel)", epdconfig.stats()['elapsed_ms'])
+
+                stages.add(f"total {name}", (time.perf_counter() - start) * 1000)
+
+                # The next song off the same album, drawn on the cached layer
+                stages.run(f"create {name} (same album)", interface.create, cover, dict(rng.choice(SONGS)))
+
+    print(f"{len(covers)} covers x {args.runs} runs, panel {eink_panel}, all times in ms")
+    stages.report()
+    # ru_maxrss is in KiB on Linux
+    print(f"Peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
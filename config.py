@@ -1,3 +1,36 @@
 
 img_width = 648
-img_height = 480
\ No newline at end of file
+img_height = 480
+
+# Give up (TimeoutError) if the panel holds BUSY longer than this
+eink_busy_timeout_ms = 60 * 1000
+
+# Waveshare driver (module in lib/waveshare_epd) for the attached panel
+eink_panel = "epd5in83b_V2"
+
+# On panels with a partial refresh, do a full refresh after this many
+# partial ones to clear the ghosting they leave behind
+eink_full_refresh_every = 10
+
+# Finished renders are cached next to the album art, older ones are deleted
+# once the cache grows past this
+render_cache_max_bytes = 64 * 1024 * 1024
+
+# Same for dithered album art
+dither_cache_max_bytes = 32 * 1024 * 1024
+
+# (connect, read) timeouts in seconds for every request to Spotify
+spotify_timeout = (3.05, 10)
+
+# Polling for the current song, in seconds. While a song plays the next poll
+# is poll_track_end_lead before it's due to end, but at least every
+# poll_heartbeat to catch skips, and every poll_near_end once it's that close.
+poll_heartbeat = 30
+poll_track_end_lead = 1.5
+poll_near_end = 1
+poll_paused = 30
+poll_inactive = 15
+
+# How many of the songs queued up next to download and render ahead of time,
+# 0 to turn it off. Needs the user-read-playback-state scope.
+prefetch_songs = 2
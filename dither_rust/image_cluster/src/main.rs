@@ -1,3 +1,4 @@
+use std::io::{self, Read, Write};
 use std::num::ParseIntError;
 
 use clap::{Args, Parser, Subcommand};
@@ -8,7 +9,7 @@ use oklab::{oklab_to_srgb, srgb_to_oklab, RGB};
 use dither::*;
 
 use image_utils::*;
-use k_means::{cluster, filter_matching_pixels};
+use k_means::{cluster, filter_matching_pixels, Rgb8Image};
 
 #[derive(Parser, Debug)]
 #[clap(author, version, about)]
@@ -38,6 +39,8 @@ enum Commands {
     Cluster(ClusterArguments),
     /// Dither the image based on the clustered colours
     Dither(DitherArguments),
+    /// Dither raw RGB frames from stdin to stdout until stdin is closed (<INPUT_IMAGE> is ignored)
+    Serve,
 }
 
 #[derive(Debug, Args)]
@@ -81,6 +84,138 @@ fn parse_colour(str: &str) -> Option<[u8; 3]> {
     ])
 }
 
+fn dither_image(
+    original: &DynamicImage,
+    img: &DynamicImage,
+    num_clusters: u32,
+    max_iterations: Option<u32>,
+    third_colour: Option<[u8; 3]>,
+    save_intermediates: bool,
+) -> Rgb8Image {
+    let rgb = original.to_rgb8();
+
+    let bw_palette = [
+        srgb_to_oklab(RGB { r: 0, g: 0, b: 0 }),
+        srgb_to_oklab(RGB {
+            r: 255,
+            g: 255,
+            b: 255,
+        }),
+    ];
+
+    if let Some(mask_rgb) = third_colour {
+        let linear: DynamicImage = to_linear(img).into();
+        let oklab_mask = srgb_to_oklab(RGB::from(mask_rgb));
+
+        let clusters = cluster(&linear, num_clusters, max_iterations, Some(oklab_mask));
+
+        let threshold = 0.15;
+        if let Some((matched, not_matched)) =
+            filter_matching_pixels(&rgb, &clusters, &oklab_mask, threshold)
+        {
+            if save_intermediates {
+                matched
+                    .save("matched.png")
+                    .unwrap_or_else(|_| panic!(" Failed writing output image to {}", "matched.png"));
+                not_matched.save("not_matched.png").unwrap_or_else(|_| {
+                    panic!(" Failed writing output image to {}", "not_matched.png")
+                });
+            }
+
+            let red_palette = [
+                srgb_to_oklab(RGB { r: 0, g: 0, b: 0 }),
+                srgb_to_oklab(RGB {
+                    r: 255,
+                    g: 255,
+                    b: 255,
+                }),
+                srgb_to_oklab(RGB { r: 255, g: 0, b: 0 }),
+            ];
+            let red_dithered = dither(&matched, &red_palette, DitherPattern::FloydSteinberg);
+
+            if save_intermediates {
+                red_dithered.save("red_dithered.png").unwrap();
+            }
+
+            let bw = DynamicImage::ImageRgb8(not_matched).to_luma16();
+            let bw = DynamicImage::ImageLuma16(bw).to_rgb8();
+
+            let mut bw_dithered = dither(&bw, &bw_palette, DitherPattern::FloydSteinberg);
+            if save_intermediates {
+                bw_dithered.save("bw_dithered.png").unwrap();
+            }
+
+            clusters
+                .iter()
+                .filter(|cluster| oklab_distance(&cluster.average_pixel, &oklab_mask) < threshold)
+                .for_each(|cluster| {
+                    cluster.members.iter().for_each(|(x, y, _)| {
+                        let px = red_dithered.get_pixel(*x, *y);
+                        bw_dithered.put_pixel(*x, *y, *px);
+                    })
+                });
+            return bw_dithered;
+        }
+    }
+    let bw = DynamicImage::ImageRgb8(rgb).to_luma16();
+    let bw = DynamicImage::ImageLuma16(bw).to_rgb8();
+    dither(&bw, &bw_palette, DitherPattern::FloydSteinberg)
+}
+
+/// Frames are read from stdin as a big endian u32 width and height, a u8
+/// flag saying whether the RGB third colour after it is used, and then
+/// width * height RGB pixels. Each frame is answered on stdout with the
+/// dithered frame in the same layout minus the third colour: width, height,
+/// pixels. Stops when stdin is closed.
+fn serve(resized_dimension: Option<u32>, num_clusters: u32, max_iterations: Option<u32>) {
+    let stdin = io::stdin();
+    let stdout = io::stdout();
+    let mut input = stdin.lock();
+    let mut output = io::BufWriter::new(stdout.lock());
+
+    loop {
+        let mut header = [0u8; 12];
+        if input.read_exact(&mut header).is_err() {
+            return;
+        }
+        let width = u32::from_be_bytes([header[0], header[1], header[2], header[3]]);
+        let height = u32::from_be_bytes([header[4], header[5], header[6], header[7]]);
+        let third_colour = if header[8] != 0 {
+            Some([header[9], header[10], header[11]])
+        } else {
+            None
+        };
+
+        let mut pixels = vec![0u8; width as usize * height as usize * 3];
+        input
+            .read_exact(&mut pixels)
+            .expect("Frame ended before all its pixels were read");
+        let frame = Rgb8Image::from_raw(width, height, pixels)
+            .expect("Frame size doesn't match its pixels");
+        let original = DynamicImage::ImageRgb8(frame);
+
+        let img = resized_dimension
+            .map(|size| get_resized_image(&original, size).into())
+            .unwrap_or_else(|| original.clone());
+
+        let dithered = dither_image(
+            &original,
+            &img,
+            num_clusters,
+            max_iterations,
+            third_colour,
+            false,
+        );
+
+        output
+            .write_all(&width.to_be_bytes())
+            .and_then(|_| output.write_all(&height.to_be_bytes()))
+            .and_then(|_| output.write_all(dithered.as_raw()))
+            .and_then(|_| output.flush())
+            .expect("Failed writing dithered frame");
+    }
+}
+
 fn main() {
     let CliArgs {
         input_image,
@@ -90,6 +225,11 @@ fn main() {
         command,
     } = CliArgs::parse();
 
+    if matches!(command, Commands::Serve) {
+        serve(resized_dimension, num_clusters, max_iterations);
+        return;
+    }
+
     let img = image::open(&input_image);
     if let Err(err) = img {
         println!("Error loading image \"{}\": {}", &input_image, err);
@@ -105,24 +245,12 @@ fn main() {
         .map(|size| get_resized_image(&original, size).into())
         .unwrap_or_else(|| original.clone());
 
-    let linear: DynamicImage = to_linear(&img).into();
-
-    let seed_colour = if let Commands::Dither(DitherArguments {
-        third_colour: Some(third_colour),
-        out_path: _,
-    }) = &command
-    {
-        parse_colour(third_colour).map(|c| srgb_to_oklab(RGB::from(c)))
-    } else {
-        None
-    };
-
-    let rgb = original.to_rgb8();
-
     match command {
         Commands::Cluster(args) => {
             let ClusterArguments { out_path } = args;
-            let clusters = cluster(&linear, num_clusters, max_iterations, seed_colour);
+            let linear: DynamicImage = to_linear(&img).into();
+            let rgb = original.to_rgb8();
+            let clusters = cluster(&linear, num_clusters, max_iterations, None);
 
             let colours: Vec<Rgb<u8>> = clusters
                 .iter()
@@ -173,78 +301,16 @@ fn main() {
                 })
             });
 
-            if let Some(mask_rgb) = third_colour {
-                let oklab_mask = srgb_to_oklab(RGB::from(mask_rgb));
-
-                let clusters = cluster(&linear, num_clusters, max_iterations, seed_colour);
-
-                let threshold = 0.15;
-                if let Some((matched, not_matched)) =
-                    filter_matching_pixels(&rgb, &clusters, &oklab_mask, threshold)
-                {
-                    matched
-                        .save("matched.png")
-                        .unwrap_or_else(|_| panic!(" Failed writing output image to {}", out_path));
-                    not_matched.save("not_matched.png").unwrap_or_else(|_| {
-                        panic!(" Failed writing output image to {}", "not_matched.png")
-                    });
-
-                    let red_palette = [
-                        srgb_to_oklab(RGB { r: 0, g: 0, b: 0 }),
-                        srgb_to_oklab(RGB {
-                            r: 255,
-                            g: 255,
-                            b: 255,
-                        }),
-                        srgb_to_oklab(RGB { r: 255, g: 0, b: 0 }),
-                    ];
-                    let red_dithered =
-                        dither(&matched, &red_palette, DitherPattern::FloydSteinberg);
-
-                    red_dithered.save("red_dithered.png").unwrap();
-
-                    let bw_palette = [
-                        srgb_to_oklab(RGB { r: 0, g: 0, b: 0 }),
-                        srgb_to_oklab(RGB {
-                            r: 255,
-                            g: 255,
-                            b: 255,
-                        }),
-                    ];
-
-                    let bw = DynamicImage::ImageRgb8(not_matched).to_luma16();
-                    let bw = DynamicImage::ImageLuma16(bw).to_rgb8();
-
-                    let mut bw_dithered = dither(&bw, &bw_palette, DitherPattern::FloydSteinberg);
-                    bw_dithered.save("bw_dithered.png").unwrap();
-
-                    clusters
-                        .iter()
-                        .filter(|cluster| {
-                            oklab_distance(&cluster.average_pixel, &oklab_mask) < threshold
-                        })
-                        .for_each(|cluster| {
-                            cluster.members.iter().for_each(|(x, y, _)| {
-                                let px = red_dithered.get_pixel(*x, *y);
-                                bw_dithered.put_pixel(*x, *y, *px);
-                            })
-                        });
-                    bw_dithered.save(out_path).unwrap();
-                    return;
-                }
-            }
-            let bw = DynamicImage::ImageRgb8(rgb).to_luma16();
-            let bw = DynamicImage::ImageLuma16(bw).to_rgb8();
-            let bw_palette = [
-                srgb_to_oklab(RGB { r: 0, g: 0, b: 0 }),
-                srgb_to_oklab(RGB {
-                    r: 255,
-                    g: 255,
-                    b: 255,
-                }),
-            ];
-            let bw_dithered = dither(&bw, &bw_palette, DitherPattern::FloydSteinberg);
-            bw_dithered.save(out_path).unwrap();
+            let dithered = dither_image(
+                &original,
+                &img,
+                num_clusters,
+                max_iterations,
+                third_colour,
+                true,
+            );
+            dithered.save(out_path).unwrap();
         }
+        Commands::Serve => unreachable!(),
     }
 }
@@ -81,6 +81,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 200
@@ -129,11 +130,17 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)
+        epdconfig.wait_until(self.busy_pin, 0)
         logging.debug("e-Paper busy release")
 
     def TurnOnDisplay(self):
@@ -201,26 +208,7 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        buf = [0xFF] * (int(self.width / 8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy*self.width) / 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
 
     def display(self, image):
         if (image == None):
@@ -230,8 +218,7 @@ class EPD:
         for j in range(0, self.height):
             self.SetCursor(0, j)
             self.send_command(0x24)
-            for i in range(0, int(self.width / 8)):
-                self.send_data(image[i + j * int(self.width / 8)])   
+            self.send_data2(image[j * int(self.width / 8):(j + 1) * int(self.width / 8)])
         self.TurnOnDisplay()
         
     def Clear(self, color):
@@ -243,8 +230,7 @@ class EPD:
         for j in range(0, self.height):
             self.SetCursor(0, j)
             self.send_command(0x24)
-            for i in range(0, int(self.width / 8)):
-                self.send_data(color)
+            self.send_data2([color] * int(self.width / 8))
         # epdconfig.digital_write(self.cs_pin, 1)
         self.TurnOnDisplay()
 
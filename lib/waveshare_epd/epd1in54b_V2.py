@@ -29,6 +29,7 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 200
@@ -64,11 +65,17 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        while(epdconfig.digital_read(self.busy_pin) == 1):
-            epdconfig.delay_ms(100)    
+        epdconfig.wait_until(self.busy_pin, 0)
         logging.debug("e-Paper busy release")
         
     def init(self):
@@ -114,35 +121,22 @@ class EPD:
         return 0
 
     def getbuffer(self, image):
-        buf = [0xFF] * int(self.width * self.height / 8)
-        # Set buffer to value of Python Imaging Library image.
         # Image must be in mode 1.
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        if imwidth != self.width or imheight != self.height:
+        if image.size != (self.width, self.height):
             raise ValueError('Image must be same dimensions as display \
                 ({0}x{1}).' .format(self.width, self.height))
-
-        pixels = image_monocolor.load()
-        for y in range(self.height):
-            for x in range(self.width):
-                # Set the bits for the column of pixels at the current position.
-                if pixels[x, y] == 0:
-                    buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
 
     def display(self, blackimage, redimage):
         # send black data
         if (blackimage != None):
             self.send_command(0x24) # DATA_START_TRANSMISSION_1
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(blackimage[i])
+            self.send_data2(blackimage)
                 
         # send red data        
         if (redimage != None):
             self.send_command(0x26) # DATA_START_TRANSMISSION_2
-            for i in range(0, int(self.width * self.height / 8)):
-                self.send_data(~redimage[i])  
+            self.send_data2(epdbuffer.invert(redimage))
 
         self.send_command(0x22) # DISPLAY_REFRESH
         self.send_data(0xF7)
@@ -151,12 +145,10 @@ class EPD:
 
     def Clear(self):
         self.send_command(0x24) # DATA_START_TRANSMISSION_1
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0xFF)
+        self.send_data2([0xFF] * int(self.width * self.height / 8))
             
         self.send_command(0x26) # DATA_START_TRANSMISSION_2
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0x00)
+        self.send_data2([0x00] * int(self.width * self.height / 8))
 
         self.send_command(0x22) # DISPLAY_REFRESH
         self.send_data(0xF7)
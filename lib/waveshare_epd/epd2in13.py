@@ -30,7 +30,7 @@
 
 import logging
 from . import epdconfig
-import numpy as np
+from . import epdbuffer
 
 # Display resolution
 EPD_WIDTH       = 122
@@ -79,10 +79,16 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
-    def ReadBusy(self):        
-        while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)            
+    def ReadBusy(self):
+        epdconfig.wait_until(self.busy_pin, 0)
 
     def TurnOnDisplay(self):
         self.send_command(0x22) # DISPLAY_UPDATE_CONTROL_2
@@ -157,33 +163,7 @@ class EPD:
         self.ReadBusy()
         
     def getbuffer(self, image):
-        if self.width%8 == 0:
-            linewidth = int(self.width/8)
-        else:
-            linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        # x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        # newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
 
         
     def display(self, image):
@@ -196,8 +176,7 @@ class EPD:
         for j in range(0, self.height):
             self.SetCursor(0, j);
             self.send_command(0x24);
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+            self.send_data2(image[j * linewidth:(j + 1) * linewidth])
         self.TurnOnDisplay()
     
     def Clear(self, color):
@@ -210,8 +189,7 @@ class EPD:
         for j in range(0, self.height):
             self.SetCursor(0, j);
             self.send_command(0x24);
-            for i in range(0, linewidth):
-                self.send_data(color)   
+            self.send_data2([color] * linewidth)
         self.TurnOnDisplay()
 
     def sleep(self):
@@ -30,7 +30,8 @@
 
 import logging
 from . import epdconfig
-import numpy as np
+from . import epdbuffer
+from PIL import Image
 
 # Display resolution
 EPD_WIDTH       = 122
@@ -103,10 +104,16 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
     def ReadBusy(self):
-        while(epdconfig.digital_read(self.busy_pin) == 1):      # 0: idle, 1: busy
-            epdconfig.delay_ms(100)    
+        epdconfig.wait_until(self.busy_pin, 0)
 
     def TurnOnDisplay(self):
         self.send_command(0x22)
@@ -215,29 +222,21 @@ class EPD:
             linewidth = int(self.width/8)
         else:
             linewidth = int(self.width/8) + 1
-         
-        buf = [0xFF] * (linewidth * self.height)
+
         image_monocolor = image.convert('1')
         imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        
         if(imwidth == self.width and imheight == self.height):
             logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):                    
-                    if pixels[x, y] == 0:
-                        x = imwidth - x
-                        buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+            # rows are mirrored: pixel x lands on bit (width - x) of its row
+            mirrored = Image.new('1', (linewidth * 8, self.height), 255)
+            mirrored.paste(image_monocolor.transpose(Image.FLIP_LEFT_RIGHT), (1, 0))
+            return bytearray(mirrored.tobytes())
         elif(imwidth == self.height and imheight == self.width):
             logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        newy = imwidth - newy - 1
-                        buf[int(newx / 8) + newy*linewidth] &= ~(0x80 >> (y % 8))
-        return buf   
+            # rotating and mirroring cancel out to a plain transpose
+            return epdbuffer.pack_1bpp(image_monocolor.transpose(Image.TRANSPOSE),
+                                       self.width, self.height)
+        return bytearray([0xFF]) * (linewidth * self.height)
         
         
     def display(self, image):
@@ -247,9 +246,7 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image)
         self.TurnOnDisplay()
         
     def displayPartial(self, image):
@@ -259,15 +256,11 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image)
                 
                 
         self.send_command(0x26)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(~image[i + j * linewidth])  
+        self.send_data2(epdbuffer.invert(image))
         self.TurnOnDisplayPart()
 
     def displayPartBaseImage(self, image):
@@ -277,15 +270,11 @@ class EPD:
             linewidth = int(self.width/8) + 1
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])   
+        self.send_data2(image)
                 
                 
         self.send_command(0x26)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(image[i + j * linewidth])  
+        self.send_data2(image)
         self.TurnOnDisplay()
     
     def Clear(self, color):
@@ -296,9 +285,7 @@ class EPD:
         # logging.debug(linewidth)
         
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, linewidth):
-                self.send_data(color)
+        self.send_data2([color] * (linewidth * self.height))
                 
         # self.send_command(0x26)
         # for j in range(0, self.height):
@@ -29,6 +29,8 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
+from PIL import Image
 
 # Display resolution
 EPD_WIDTH       = 280
@@ -130,12 +132,18 @@ class EPD:
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
 
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
+
 
     def ReadBusy(self):
         logging.debug("e-Paper busy")
-        while(epdconfig.digital_read(self.busy_pin) == 1):      #  0: idle, 1: busy
-            epdconfig.delay_ms(200) 
-        logging.debug("e-Paper busy release") 
+        epdconfig.wait_until(self.busy_pin, 0)
+        logging.debug("e-Paper busy release")
 
 
     def init(self, mode):
@@ -237,71 +245,20 @@ class EPD:
 
 
     def getbuffer(self, image):
-        # logging.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width/8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # logging.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy*self.width) / 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
 
 
     def getbuffer_4Gray(self, image):
-        # logging.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
-        image_monocolor = image.convert('L')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logging.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i = i + 1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = imwidth - x - 1
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i = i + 1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
-        return buf
+        return epdbuffer.pack_4gray(image, self.width, self.height, sideways=Image.ROTATE_90)
 
 
     def display_4Gray(self, image):
         if (image == None):
             return            
 
+        # white/black/gray1/gray2 are sent as the two bits of their gray code
+        high, low = epdbuffer.split_4gray(image, self.width, self.height)
+
         self.send_command(0x4E)
         self.send_data(0x00)
         self.send_data(0x00)
@@ -310,35 +267,7 @@ class EPD:
         self.send_data(0x00)
 
         self.send_command(0x24)
-        for i in range(0, (int)(self.height*(self.width/8))):
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x01           #white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00           #black
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00           #gray1
-                    else:                       #0x40
-                        temp3 |= 0x01           #gray2
-                    temp3 <<= 1
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):          #white
-                        temp3 |= 0x01
-                    elif(temp2 == 0x00):        #black
-                        temp3 |= 0x00
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00           #gray1
-                    else:                       #0x40
-                        temp3 |= 0x01           #gray2
-                    if(j!=1 or k!=1):
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
+        self.send_data2(low)
 
         self.send_command(0x4E)
         self.send_data(0x00)
@@ -348,35 +277,7 @@ class EPD:
         self.send_data(0x00)
 
         self.send_command(0x26)
-        for i in range(0, (int)(self.height*(self.width/8))):
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x01       #white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00       #black
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01       #gray1
-                    else:                   #0x40
-                        temp3 |= 0x00       #gray2
-                    temp3 <<= 1
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):      #white
-                        temp3 |= 0x01
-                    elif(temp2 == 0x00):    #black
-                        temp3 |= 0x00
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01       #gray1
-                    else:                   #0x40
-                        temp3 |= 0x00       #gray2
-                    if(j!=1 or k!=1):
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
+        self.send_data2(high)
 
         self.load_lut(self.lut_4Gray_GC)
         self.send_command(0x22)
@@ -397,9 +298,7 @@ class EPD:
         self.send_data(0x00)
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, int(self.width / 8)):
-                self.send_data(image[i + j * int(self.width / 8)])   
+        self.send_data2(image)
 
         self.load_lut(self.lut_1Gray_DU)
         self.send_command(0x20)
@@ -415,15 +314,11 @@ class EPD:
         self.send_data(0x00)
 
         self.send_command(0x24)
-        for j in range(0, self.height):
-            for i in range(0, int(self.width / 8)):
-                self.send_data(0xff)   
+        self.send_data2([0xff] * (int(self.width / 8) * self.height))
 
         if(mode == 0):              #4Gray
             self.send_command(0x26)
-            for j in range(0, self.height):
-                for i in range(0, int(self.width / 8)):
-                    self.send_data(0xff) 
+            self.send_data2([0xff] * (int(self.width / 8) * self.height))
             self.load_lut(self.lut_4Gray_GC)
             self.send_command(0x22)
             self.send_data(0xC7)
@@ -30,8 +30,8 @@
 
 import logging
 from . import epdconfig
+from . import epdbuffer
 from PIL import Image
-import RPi.GPIO as GPIO
 
 # Display resolution
 EPD_WIDTH       = 400
@@ -219,12 +219,17 @@ class EPD:
         epdconfig.digital_write(self.cs_pin, 0)
         epdconfig.spi_writebyte([data])
         epdconfig.digital_write(self.cs_pin, 1)
+
+    # send a whole payload with DC/CS asserted once
+    def send_data2(self, data):
+        epdconfig.digital_write(self.dc_pin, 1)
+        epdconfig.digital_write(self.cs_pin, 0)
+        epdconfig.spi_writebyte2(data)
+        epdconfig.digital_write(self.cs_pin, 1)
         
     def ReadBusy(self):
         self.send_command(0x71)
-        while(epdconfig.digital_read(self.busy_pin) == 0):      # 0: idle, 1: busy
-            self.send_command(0x71)
-            epdconfig.delay_ms(100)    
+        epdconfig.wait_until(self.busy_pin, 1, lambda: self.send_command(0x71))
 
     def set_lut(self):
         self.send_command(0x20)               # vcom
@@ -380,76 +385,19 @@ class EPD:
         self.send_data(0x97)
 
     def getbuffer(self, image):
-        # logging.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width/8) * self.height)
-        image_monocolor = image.convert('1')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        # logging.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Horizontal")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if pixels[x, y] == 0:
-                        buf[int((x + y * self.width) / 8)] &= ~(0x80 >> (x % 8))
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    newx = y
-                    newy = self.height - x - 1
-                    if pixels[x, y] == 0:
-                        buf[int((newx + newy*self.width) / 8)] &= ~(0x80 >> (y % 8))
-        return buf
+        return epdbuffer.pack_1bpp(image, self.width, self.height)
         
     def getbuffer_4Gray(self, image):
-        # logging.debug("bufsiz = ",int(self.width/8) * self.height)
-        buf = [0xFF] * (int(self.width / 4) * self.height)
-        image_monocolor = image.convert('L')
-        imwidth, imheight = image_monocolor.size
-        pixels = image_monocolor.load()
-        i=0
-        # logging.debug("imwidth = %d, imheight = %d",imwidth,imheight)
-        if(imwidth == self.width and imheight == self.height):
-            logging.debug("Vertical")
-            for y in range(imheight):
-                for x in range(imwidth):
-                    # Set the bits for the column of pixels at the current position.
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((x + (y * self.width))/4)] = ((pixels[x-3, y]&0xc0) | (pixels[x-2, y]&0xc0)>>2 | (pixels[x-1, y]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6)
-                        
-        elif(imwidth == self.height and imheight == self.width):
-            logging.debug("Horizontal")
-            for x in range(imwidth):
-                for y in range(imheight):
-                    newx = y
-                    newy = x
-                    if(pixels[x, y] == 0xC0):
-                        pixels[x, y] = 0x80
-                    elif (pixels[x, y] == 0x80):
-                        pixels[x, y] = 0x40
-                    i= i+1
-                    if(i%4 == 0):
-                        buf[int((newx + (newy * self.width))/4)] = ((pixels[x, y-3]&0xc0) | (pixels[x, y-2]&0xc0)>>2 | (pixels[x, y-1]&0xc0)>>4 | (pixels[x, y]&0xc0)>>6) 
-        
-        return buf
+        return epdbuffer.pack_4gray(image, self.width, self.height, sideways=Image.TRANSPOSE)
 
     def display(self, image):
         self.send_command(0x92);	
         self.set_lut();
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0xFF)
+        self.send_data2([0xFF] * int(self.width * self.height / 8))
             
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(image[i])
+        self.send_data2(image)
             
         self.send_command(0x12) 
         self.ReadBusy()
@@ -485,15 +433,16 @@ class EPD:
         self.send_data (int(Y_end%256)-1);  #y-end
         self.send_data (0x28);	
 
-        self.send_command(0x10);	       #writes Old data to SRAM for programming
+        window = bytearray()
         for j in range(0, int(Y_end - Y_start)):
-            for i in range(0, int(X_end/8) - int(X_start/8)):
-                self.send_data(Image[(Y_start + j)*Width + int(X_start/8) + i]);
+            row_start = (Y_start + j)*Width + int(X_start/8)
+            window += bytes(Image[row_start:row_start + int(X_end/8) - int(X_start/8)])
+
+        self.send_command(0x10);	       #writes Old data to SRAM for programming
+        self.send_data2(window)
             
         self.send_command(0x13);				 #writes New data to SRAM.
-        for j in range(0, int(Y_end - Y_start)):
-            for i in range(0, int(X_end/8) - int(X_start/8)):
-                self.send_data(~Image[(Y_start + j)*Width + int(X_start/8) + i]);
+        self.send_data2(epdbuffer.invert(window))
             
         self.send_command(0x12);		 #DISPLAY REFRESH 		             
         epdconfig.delay_ms(200)    #The delay here is necessary, 200uS at least!!!     
@@ -501,72 +450,15 @@ class EPD:
 
 
     def display_4Gray(self, image):
+        # white/black/gray1/gray2 are sent as the two bits of their gray code
+        high, low = epdbuffer.split_4gray(image, self.width, self.height)
         self.send_command(0x92);	
         self.set_lut();
         self.send_command(0x10)
-        for i in range(0, int(EPD_WIDTH * EPD_HEIGHT / 8)):                   # EPD_WIDTH * EPD_HEIGHT / 4
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x01#white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00  #black
-                    elif(temp2 == 0x80): 
-                        temp3 |= 0x01  #gray1
-                    else: #0x40
-                        temp3 |= 0x00 #gray2
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):  #white
-                        temp3 |= 0x01
-                    elif(temp2 == 0x00): #black
-                        temp3 |= 0x00
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x01 #gray1
-                    else :   #0x40
-                            temp3 |= 0x00	#gray2	
-                    if(j!=1 or k!=1):				
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
+        self.send_data2(high)
             
         self.send_command(0x13)	    
-               
-        for i in range(0, int(EPD_WIDTH * EPD_HEIGHT / 8)):                #5808*4  46464
-            temp3=0
-            for j in range(0, 2):
-                temp1 = image[i*2+j]
-                for k in range(0, 2):
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):
-                        temp3 |= 0x01#white
-                    elif(temp2 == 0x00):
-                        temp3 |= 0x00  #black
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00  #gray1
-                    else: #0x40
-                        temp3 |= 0x01 #gray2
-                    temp3 <<= 1	
-                    
-                    temp1 <<= 2
-                    temp2 = temp1&0xC0 
-                    if(temp2 == 0xC0):  #white
-                        temp3 |= 0x01
-                    elif(temp2 == 0x00): #black
-                        temp3 |= 0x00
-                    elif(temp2 == 0x80):
-                        temp3 |= 0x00 #gray1
-                    else:    #0x40
-                            temp3 |= 0x01	#gray2
-                    if(j!=1 or k!=1):					
-                        temp3 <<= 1
-                    temp1 <<= 2
-            self.send_data(temp3)
+        self.send_data2(low)
         
         self.Gray_SetLut()
         self.send_command(0x12)
@@ -576,12 +468,10 @@ class EPD:
     
     def Clear(self):
         self.send_command(0x10)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0xFF)
+        self.send_data2([0xFF] * int(self.width * self.height / 8))
             
         self.send_command(0x13)
-        for i in range(0, int(self.width * self.height / 8)):
-            self.send_data(0xFF)
+        self.send_data2([0xFF] * int(self.width * self.height / 8))
             
         self.send_command(0x12) 
         self.ReadBusy()
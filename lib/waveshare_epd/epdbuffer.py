@@ -0,0 +1,217 @@
+# Framebuffer helpers shared by the e-paper drivers.
+#
+# Nothing in here touches the hardware, so it can be imported (and the buffers
+# it produces inspected) on machines without SPI/GPIO.
+
+from PIL import Image, ImageChops
+
+_INVERT_TABLE = bytes(range(0xFF, -1, -1))
+
+
+def _build_table(convert):
+    return [convert(value) for value in range(256)]
+
+
+def _double_bits(value):
+    # 1 bit per pixel -> 2 bits per pixel, a set bit becomes 0b11
+    out = 0
+    for bit in range(8):
+        if value & (0x80 >> bit):
+            out |= 0xC000 >> (bit * 2)
+    return out.to_bytes(2, 'big')
+
+
+def _gray_to_nibbles(value):
+    # 2 bits per pixel -> 4 bits per pixel: 0b11 is white (0x3), 0b00 black
+    # (0x0) and anything in between is sent as red (0x4)
+    out = 0
+    for pixel in range(4):
+        code = (value >> (6 - pixel * 2)) & 0x03
+        nibble = 0x03 if code == 0x03 else 0x00 if code == 0x00 else 0x04
+        out |= nibble << (12 - pixel * 4)
+    return out.to_bytes(2, 'big')
+
+
+def _bits_to_nibbles(value):
+    # 1 bit per pixel -> 4 bits per pixel, a set bit becomes 0xF
+    out = 0
+    for bit in range(8):
+        if value & (0x80 >> bit):
+            out |= 0xF << (28 - bit * 4)
+    return out.to_bytes(4, 'big')
+
+
+# ACeP colour indices, any other colour is sent as black (0)
+_ACEP_COLORS = {
+    (0, 0, 0): 0,           # black
+    (255, 255, 255): 1,     # white
+    (0, 255, 0): 2,         # green
+    (0, 0, 255): 3,         # blue
+    (255, 0, 0): 4,         # red
+    (255, 255, 0): 5,       # yellow
+    (255, 128, 0): 6,       # orange
+}
+
+# Every channel value the palette uses gets a small code (0 = unused value),
+# and (r, g, b) codes combine into a single 6 bit key per pixel
+_ACEP_CHANNEL_CODES = {0: 1, 128: 2, 255: 3}
+
+
+def _acep_channel_table(shift):
+    return [_ACEP_CHANNEL_CODES.get(value, 0) << shift for value in range(256)]
+
+
+def _acep_key_table():
+    table = [0] * 256
+    for (r, g, b), color in _ACEP_COLORS.items():
+        key = (_ACEP_CHANNEL_CODES[r] << 4) | (_ACEP_CHANNEL_CODES[g] << 2) | _ACEP_CHANNEL_CODES[b]
+        table[key] = color
+    return table
+
+
+_ACEP_RGB_TABLE = _acep_channel_table(4) + _acep_channel_table(2) + _acep_channel_table(0)
+_ACEP_KEY_TABLE = _acep_key_table()
+
+
+def _gray_code(value):
+    # 4 gray levels, 0 (black) to 3 (white). The two exact levels the 4-gray
+    # demo images use for the grays (0x80 and 0xC0) are pulled down one step.
+    if value == 0xC0:
+        value = 0x80
+    elif value == 0x80:
+        value = 0x40
+    return value >> 6
+
+
+_GRAY_CODE_TABLE = [_gray_code(value) for value in range(256)]
+# The two bit-planes of a gray code, as mode "1" lookup tables
+_GRAY_HIGH_BIT_TABLE = [255 if code & 0x02 else 0 for code in range(4)] + [0] * 252
+_GRAY_LOW_BIT_TABLE = [255 if code & 0x01 else 0 for code in range(4)] + [0] * 252
+
+_DOUBLE_BITS_TABLE = _build_table(_double_bits)
+_GRAY_TO_NIBBLES_TABLE = _build_table(_gray_to_nibbles)
+_BITS_TO_NIBBLES_TABLE = _build_table(_bits_to_nibbles)
+
+
+def _expand(buf, table):
+    return b''.join(map(table.__getitem__, buf))
+
+
+def invert(buf):
+    # Equivalent to sending ~buf[i] for every byte, done in one C-level pass
+    return bytes(buf).translate(_INVERT_TABLE)
+
+
+def double_bits(buf):
+    return _expand(buf, _DOUBLE_BITS_TABLE)
+
+
+def gray_to_nibbles(buf):
+    return _expand(buf, _GRAY_TO_NIBBLES_TABLE)
+
+
+def merge_black_red_nibbles(black, red):
+    # Two 1 bit planes (0 = ink) -> one 4 bit plane: red (0x4) wins over
+    # black (0x0), everything else is white (0x3). The planes are combined as
+    # big integers so the whole frame is processed without a Python loop.
+    size = len(black) * 4
+    b = int.from_bytes(_expand(black, _BITS_TO_NIBBLES_TABLE), 'big')
+    r = int.from_bytes(_expand(red, _BITS_TO_NIBBLES_TABLE), 'big')
+    not_r = r ^ ((1 << (size * 8)) - 1)
+    white = int.from_bytes(b'\x33' * size, 'big')
+    red_ink = int.from_bytes(b'\x44' * size, 'big')
+    return ((r & b & white) | (not_r & red_ink)).to_bytes(size, 'big')
+
+
+def pack_1bpp(image, width, height, fill=0xFF):
+    # Pack an image into the 1 bit per pixel layout the panels expect: rows of
+    # width pixels, MSB first, 1 = white, each row padded to a whole byte with
+    # white. This is exactly PIL's raw packing of a mode "1" image, so the work
+    # happens in C instead of one Python iteration per pixel.
+    #
+    # An image of height x width is taken to be the panel turned on its side
+    # and is rotated to match. Any other size gives a buffer of `fill`.
+    linewidth = (width + 7) // 8
+    image_monocolor = image.convert('1')
+    if image_monocolor.size == (height, width) and width != height:
+        image_monocolor = image_monocolor.transpose(Image.ROTATE_90)
+    elif image_monocolor.size != (width, height):
+        return bytearray([fill]) * (linewidth * height)
+
+    buf = bytearray(image_monocolor.tobytes())
+    if width % 8 != 0:
+        # PIL pads with 0 (black), the panels expect the unused bits left white
+        padding = 0xFF >> (width % 8)
+        buf[linewidth - 1::linewidth] = bytes(
+            byte | padding for byte in buf[linewidth - 1::linewidth])
+    return buf
+
+
+def _acep_indices(image):
+    # Map every pixel to its ACeP colour index, as a mode "P" image
+    if image.mode == 'P':
+        # Classify the 256 palette entries once and remap the pixel indices
+        palette = (image.getpalette() + [0] * 768)[:768]
+        table = [_ACEP_COLORS.get(tuple(palette[i * 3:i * 3 + 3]), 0) for i in range(256)]
+        indices = Image.frombytes('L', image.size, image.tobytes()).point(table)
+    else:
+        r, g, b = image.convert('RGB').point(_ACEP_RGB_TABLE).split()
+        indices = ImageChops.add(ImageChops.add(r, g), b).point(_ACEP_KEY_TABLE)
+    return Image.frombytes('P', indices.size, indices.tobytes())
+
+
+def pack_7color(image, width, height):
+    # Pack an RGB (or palette) image into the 4 bits per pixel ACeP layout:
+    # two pixels per byte, the left one in the high nibble. Orientation is
+    # handled the same way as pack_1bpp, other sizes give an all black buffer.
+    if image.size == (height, width) and width != height:
+        image = image.transpose(Image.ROTATE_90)
+    elif image.size != (width, height):
+        return bytearray(int(width * height / 2))
+
+    return bytearray(_acep_indices(image).tobytes('raw', 'P;4'))
+
+
+def pack_4gray(image, width, height, sideways=Image.ROTATE_90):
+    # Pack an image into 2 bits per pixel gray codes, four pixels per byte, MSB
+    # first. `sideways` is the transpose applied to a height x width image,
+    # since not every 4-gray driver maps rotated images the same way. Other
+    # sizes give an all white buffer.
+    image_grayscale = image.convert('L')
+    if image_grayscale.size == (height, width) and width != height:
+        image_grayscale = image_grayscale.transpose(sideways)
+    elif image_grayscale.size != (width, height):
+        return bytearray([0xFF]) * int(width / 4 * height)
+
+    codes = image_grayscale.point(_GRAY_CODE_TABLE)
+    codes = Image.frombytes('P', codes.size, codes.tobytes())
+    return bytearray(codes.tobytes('raw', 'P;2'))
+
+
+def split_4gray(buf, width, height):
+    # Split a pack_4gray buffer into its (high bit, low bit) 1 bit planes
+    codes = Image.frombytes('P', (width, height), bytes(buf), 'raw', 'P;2')
+    codes = Image.frombytes('L', codes.size, codes.tobytes())
+    return (codes.point(_GRAY_HIGH_BIT_TABLE, '1').tobytes(),
+            codes.point(_GRAY_LOW_BIT_TABLE, '1').tobytes())
+
+
+def dirty_box(previous, current, width, height):
+    # Bounding box (x_start, y_start, x_end, y_end), end exclusive, of the
+    # pixels that differ between two 1bpp buffers, widened to whole bytes.
+    # None if they're identical.
+    linewidth = (width + 7) // 8
+    box = ImageChops.difference(
+        Image.frombytes('L', (linewidth, height), bytes(previous)),
+        Image.frombytes('L', (linewidth, height), bytes(current))).getbbox()
+    if box is None:
+        return None
+    x_start, y_start, x_end, y_end = box
+    return x_start * 8, y_start, min(x_end * 8, width), y_end
+
+
+def merge_planes(black, red):
+    # Fold a red plane into the black one (0 = ink in both), for panels that
+    # can only show black
+    size = len(black)
+    return (int.from_bytes(bytes(black), 'big') & int.from_bytes(bytes(red), 'big')).to_bytes(size, 'big')
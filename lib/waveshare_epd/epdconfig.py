@@ -32,6 +32,17 @@ import logging
 import sys
 import time
 
+# Longest a driver waits for the panel to release BUSY before giving up.
+# Tri-colour panels take ~15-20 s for a full refresh.
+busy_timeout_ms = 60 * 1000
+
+# How often a BUSY wait wakes up to re-check the pin (and re-poll the
+# controller status, for drivers that need it) even without an edge
+BUSY_WAKE_MS = 200
+
+# Sleep between reads when the pin can't be edge-triggered
+BUSY_POLL_FALLBACK_MS = 10
+
 
 class RaspberryPi:
     # Pin definition
@@ -49,6 +60,10 @@ class RaspberryPi:
         # SPI device, bus = 0, device = 0
         self.SPI = spidev.SpiDev(0, 0)
 
+        # writebytes rejects anything over 4096 bytes whatever spidev's
+        # bufsiz, writebytes2 (py-spidev 3.3+) splits by bufsiz itself
+        self.SPI_CHUNK_SIZE = 4096
+
     def digital_write(self, pin, value):
         self.GPIO.output(pin, value)
 
@@ -58,9 +73,24 @@ class RaspberryPi:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, value, timeout_ms):
+        edge = self.GPIO.RISING if value else self.GPIO.FALLING
+        try:
+            self.GPIO.wait_for_edge(pin, edge, timeout=max(1, int(timeout_ms)))
+        except RuntimeError:
+            # Edge detection is unavailable on this pin, fall back to polling
+            self.delay_ms(min(timeout_ms, BUSY_POLL_FALLBACK_MS))
+
     def spi_writebyte(self, data):
         self.SPI.writebytes(data)
 
+    def spi_writebyte2(self, data):
+        if hasattr(self.SPI, 'writebytes2'):
+            self.SPI.writebytes2(data)
+            return
+        for start in range(0, len(data), self.SPI_CHUNK_SIZE):
+            self.SPI.writebytes(list(data[start:start + self.SPI_CHUNK_SIZE]))
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -118,9 +148,23 @@ class JetsonNano:
     def delay_ms(self, delaytime):
         time.sleep(delaytime / 1000.0)
 
+    def wait_for_edge(self, pin, value, timeout_ms):
+        edge = self.GPIO.RISING if value else self.GPIO.FALLING
+        try:
+            self.GPIO.wait_for_edge(pin, edge, timeout=max(1, int(timeout_ms)))
+        except RuntimeError:
+            # Edge detection is unavailable on this pin, fall back to polling
+            self.delay_ms(min(timeout_ms, BUSY_POLL_FALLBACK_MS))
+
     def spi_writebyte(self, data):
         self.SPI.SYSFS_software_spi_transfer(data[0])
 
+    def spi_writebyte2(self, data):
+        # Software SPI has no block transfer, but the caller still only
+        # toggles DC/CS once for the whole payload
+        for byte in data:
+            self.SPI.SYSFS_software_spi_transfer(byte)
+
     def module_init(self):
         self.GPIO.setmode(self.GPIO.BCM)
         self.GPIO.setwarnings(False)
@@ -142,7 +186,260 @@ class JetsonNano:
         self.GPIO.cleanup()
 
 
-if os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
+# Panels the simulator knows how to model, keyed by driver module name.
+#   busy / partial_busy: ms BUSY is held after each command, full / partial
+#   busy_level: what BUSY reads while busy
+#   refresh: the command that starts a refresh
+#   black_ram: RAM command holding the image (1 = white) after a full refresh
+#   partial_ram: the same after a partial refresh
+#   red_ram: RAM command holding the red plane (1 = red), tri-colour only
+#   window16: 0x90 sets a partial window with 16 bit coordinates
+#   partial_enter / partial_exit: commands switching partial mode on / off
+#   partial_update: 0x22 parameter selecting a partial update (SSD16xx)
+SIMULATED_PANELS = {
+    'epd5in83b_V2': dict(width=648, height=480, busy_level=0, refresh=0x12,
+                         busy={0x12: 16000, 0x04: 100, 0x02: 40},
+                         black_ram=0x10, red_ram=0x13),
+    'epd4in2': dict(width=400, height=300, busy_level=0, refresh=0x12,
+                    busy={0x12: 4000, 0x04: 100, 0x02: 40},
+                    partial_busy={0x12: 600},
+                    black_ram=0x13, partial_ram=0x10, window16=True,
+                    partial_enter=(0x91,), partial_exit=(0x92,)),
+    'epd2in13_V2': dict(width=122, height=250, busy_level=1, refresh=0x20,
+                        busy={0x20: 2000, 0x12: 10},
+                        partial_busy={0x20: 300},
+                        black_ram=0x24, partial_update=0x0C, mirror_x=True),
+    'epd2in9d': dict(width=128, height=296, busy_level=0, refresh=0x12,
+                     busy={0x12: 2000, 0x04: 100, 0x02: 40},
+                     partial_busy={0x12: 300},
+                     black_ram=0x13, partial_ram=0x10,
+                     partial_enter=(0x91,), partial_exit=(0x92, 0x50)),
+    'epd1in02': dict(width=80, height=128, busy_level=0, refresh=0x12,
+                     busy={0x12: 1500, 0x04: 100, 0x02: 40},
+                     partial_busy={0x12: 250},
+                     black_ram=0x13, partial_ram=0x13,
+                     partial_enter=(0x91,), partial_exit=(0x92,)),
+}
+
+
+class Simulated:
+    # No hardware at all: every pin write and SPI byte is recorded and decoded
+    # into commands, BUSY follows a per-panel timing model on a virtual clock
+    # (nothing actually sleeps) and the RAM writes are replayed to rebuild
+    # what the panel would show.
+    RST_PIN         = 17
+    DC_PIN          = 25
+    CS_PIN          = 8
+    BUSY_PIN        = 24
+
+    SPI_HZ          = 4000000
+
+    def __init__(self, panel):
+        if panel not in SIMULATED_PANELS:
+            raise RuntimeError('No simulated model for %s, known panels: %s'
+                               % (panel, ', '.join(sorted(SIMULATED_PANELS))))
+        self.panel = panel
+        self._model = SIMULATED_PANELS[panel]
+        self._linewidth = (self._model['width'] + 7) // 8
+        self._pins = {}
+        self._ram = {}
+        self._shown = None
+        self._shown_red = None
+        self.reset_stats()
+        self._reset_controller()
+
+    def _reset_controller(self):
+        self._busy_until = 0.0
+        self._partial = False
+        self._window = None
+        self._command = None
+        self._data = bytearray()
+
+    def reset_stats(self):
+        self._clock = 0.0
+        self._transactions = []
+        self._pin_transitions = []
+        self._spi_calls = 0
+        self._bytes = 0
+        self._busy_ms = 0.0
+        self._refreshes = 0
+
+    def stats(self):
+        return {
+            'elapsed_ms': self._clock,
+            'busy_ms': self._busy_ms,
+            'bytes': self._bytes,
+            'spi_calls': self._spi_calls,
+            'commands': len(self._transactions),
+            'pin_transitions': len(self._pin_transitions),
+            'refreshes': self._refreshes,
+        }
+
+    def transactions(self):
+        # [(clock ms, command, data bytes)]
+        self._finish_command()
+        return list(self._transactions)
+
+    def pin_transitions(self):
+        # [(clock ms, pin, value)]
+        return list(self._pin_transitions)
+
+    def digital_write(self, pin, value):
+        if self._pins.get(pin) != value:
+            self._pin_transitions.append((self._clock, pin, value))
+            if pin == self.RST_PIN and value and self._pins.get(pin) == 0:
+                self._reset_controller()
+                self._busy_until = self._clock + 10
+        self._pins[pin] = value
+
+    def digital_read(self, pin):
+        if pin == self.BUSY_PIN and self._clock < self._busy_until:
+            return self._model['busy_level']
+        if pin == self.BUSY_PIN:
+            return 1 - self._model['busy_level']
+        return self._pins.get(pin, 0)
+
+    def delay_ms(self, delaytime):
+        self._clock += delaytime
+
+    def wait_for_edge(self, pin, value, timeout_ms):
+        # BUSY is the only input, it changes when the modelled busy time ends
+        if self._clock < self._busy_until:
+            waited = min(self._busy_until - self._clock, timeout_ms)
+            self._busy_ms += waited
+            self._clock += waited
+        else:
+            self._clock += timeout_ms
+
+    def spi_writebyte(self, data):
+        self._transfer(data)
+
+    def spi_writebyte2(self, data):
+        self._transfer(data)
+
+    def _transfer(self, data):
+        self._spi_calls += 1
+        self._bytes += len(data)
+        self._clock += len(data) * 8 * 1000.0 / self.SPI_HZ
+        if self._pins.get(self.DC_PIN, 0):
+            self._data += bytes(data)
+            return
+        for byte in data:
+            self._start_command(byte)
+
+    def _start_command(self, command):
+        self._finish_command()
+        self._command = command
+        model = self._model
+        if command in model.get('partial_enter', ()):
+            self._partial = True
+        elif command in model.get('partial_exit', ()):
+            self._partial = False
+            self._window = None
+
+        busy = model['busy']
+        if self._partial and 'partial_busy' in model:
+            busy = {**busy, **model['partial_busy']}
+        if command in busy:
+            self._busy_until = self._clock + busy[command]
+        if command == model['refresh']:
+            self._refresh()
+
+    def _finish_command(self):
+        command, data = self._command, bytes(self._data)
+        if command is None:
+            return
+        self._transactions.append((self._clock, command, data))
+        self._command = None
+        self._data = bytearray()
+
+        model = self._model
+        if command == 0x90 and model.get('window16') and len(data) >= 8:
+            self._window = ((data[0] << 8 | data[1]) // 8, (data[4] << 8 | data[5]),
+                            (data[2] << 8 | data[3]) // 8 + 1, (data[6] << 8 | data[7]) + 1)
+        elif command == 0x22 and 'partial_update' in model and data:
+            self._partial = data[0] == model['partial_update']
+        elif command in (model['black_ram'], model.get('partial_ram'), model.get('red_ram')):
+            self._write_ram(command, data)
+
+    def _plane(self, command):
+        if command not in self._ram:
+            blank = 0x00 if command == self._model.get('red_ram') else 0xFF
+            self._ram[command] = bytearray([blank]) * (self._linewidth * self._model['height'])
+        return self._ram[command]
+
+    def _write_ram(self, command, data):
+        plane = self._plane(command)
+        if self._partial and self._window is not None:
+            x_start, y_start, x_end, y_end = self._window
+            row = x_end - x_start
+            for y in range(y_start, y_end):
+                offset = (y - y_start) * row
+                plane[y * self._linewidth + x_start:y * self._linewidth + x_end] = data[offset:offset + row]
+        else:
+            plane[:len(data)] = data[:len(plane)]
+
+    def _refresh(self):
+        self._refreshes += 1
+        model = self._model
+        if self._partial and 'partial_ram' in model:
+            source = self._plane(model['partial_ram'])
+            if self._shown is None:
+                self._shown = bytearray(self._plane(model['black_ram']))
+            if self._window is None:
+                self._shown[:] = source
+            else:
+                x_start, y_start, x_end, y_end = self._window
+                for y in range(y_start, y_end):
+                    row = slice(y * self._linewidth + x_start, y * self._linewidth + x_end)
+                    self._shown[row] = source[row]
+        else:
+            self._shown = bytearray(self._plane(model['black_ram']))
+        if 'red_ram' in model:
+            self._shown_red = bytes(self._plane(model['red_ram']))
+
+    def image(self):
+        # What the panel shows after the last refresh, as an RGB image
+        from PIL import Image
+        size = (self._model['width'], self._model['height'])
+        white = Image.new('RGB', size, (255, 255, 255))
+        if self._shown is None:
+            return white
+        black = self._shown_plane(self._shown)
+        image = Image.composite(white, Image.new('RGB', size, (0, 0, 0)), black)
+        if self._shown_red is not None:
+            red = self._shown_plane(self._shown_red)
+            image.paste((255, 0, 0), mask=red)
+        return image
+
+    def _shown_plane(self, data):
+        from PIL import Image
+        width, height = self._model['width'], self._model['height']
+        if not self._model.get('mirror_x'):
+            return Image.frombytes('1', (width, height), bytes(data))
+        # Rows wired right to left, the driver puts pixel x on bit (width - x)
+        # of its row
+        padded = self._linewidth * 8
+        rows = Image.frombytes('1', (padded, height), bytes(data)).transpose(Image.FLIP_LEFT_RIGHT)
+        return rows.crop((padded - 1 - width, 0, padded - 1, height))
+
+    def save_png(self, path):
+        self.image().save(path, 'PNG')
+
+    def module_init(self):
+        return 0
+
+    def module_exit(self):
+        logging.debug("spi end")
+        self._finish_command()
+        self.digital_write(self.RST_PIN, 0)
+        self.digital_write(self.DC_PIN, 0)
+
+
+# EPD_SIMULATE=<driver module name> replaces the hardware with Simulated
+if os.environ.get('EPD_SIMULATE'):
+    implementation = Simulated(os.environ['EPD_SIMULATE'])
+elif os.path.exists('/sys/bus/platform/drivers/gpiomem-bcm2835'):
     implementation = RaspberryPi()
 else:
     implementation = JetsonNano()
@@ -151,4 +448,19 @@ for func in [x for x in dir(implementation) if not x.startswith('_')]:
     setattr(sys.modules[__name__], func, getattr(implementation, func))
 
 
+def wait_until(pin, value, poll=None):
+    # Block until pin reads value, waking on the GPIO edge instead of sleeping
+    # a fixed interval. poll is called every time the wait wakes up without
+    # the pin having changed, for controllers that only refresh BUSY after a
+    # status read. Raises TimeoutError after busy_timeout_ms.
+    deadline = time.monotonic() + busy_timeout_ms / 1000.0
+    while digital_read(pin) != value:
+        remaining_ms = (deadline - time.monotonic()) * 1000.0
+        if remaining_ms <= 0:
+            raise TimeoutError("e-Paper still busy after %d ms" % busy_timeout_ms)
+        wait_for_edge(pin, value, min(remaining_ms, BUSY_WAKE_MS))
+        if poll is not None:
+            poll()
+
+
 ### END OF FILE ###
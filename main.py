@@ -1,8 +1,7 @@
 import spotifyApi as S
-import pprint
+import asyncio
 import os
 import os.path
-import subprocess
 import unicodedata
 import re
 import time
@@ -10,10 +9,13 @@ import random
 
 import io
 
+from concurrent.futures import ThreadPoolExecutor
+
 from sys import platform
 from sys import argv
 
-from AlbumDisplay import BasicInterface, MirroredInterface, RawAlbumInterface
+from AlbumDisplay import BasicInterface, MirroredInterface, RawAlbumInterface, RenderCache
+from Dither import DitherCache, dither_engine, dither_function
 from ImageDrawer import BasicDrawer, EinkDrawer
 from Log import LogLevel, LogCategory, log
 
@@ -21,7 +23,9 @@ from PIL import Image
 
 import secrets
 
-from config import img_height, img_width
+from config import dither_cache_max_bytes, img_height, img_width, render_cache_max_bytes
+from config import poll_heartbeat, poll_inactive, poll_near_end, poll_paused, poll_track_end_lead
+from config import prefetch_songs
 
 
 def get_file_name(name, image_path):
@@ -39,7 +43,10 @@ def download_image(api, url, file_path):
         code, response = api.make_request(url)
         if code == 200:
             with Image.open(io.BytesIO(response.content)) as img:
-                img.save(file_path)
+                # Written under a temporary name first so a half written file
+                # is never taken for a cached one
+                img.save(f'{file_path}.tmp', 'PNG')
+                os.replace(f'{file_path}.tmp', file_path)
                 log(LogLevel.INFO, LogCategory.ALBUMART,
                     f"{file_path} downloaded")
         else:
@@ -50,116 +57,201 @@ def download_image(api, url, file_path):
     return True
 
 
-def resize_image(image_path, target_height):
-    album_height = current_song['album_image_height']
-    scale = img_height / album_height
-    working_image_path = f'{image_path}/curr.png'
-
-    log(LogLevel.INFO, LogCategory.ALBUMART, "Resizing image")
-    with Image.open(image_file_name) as img:
-        img = img.resize((int(album_height * scale),
-                         int(album_height * scale)))
-        img.save(working_image_path)
-
-
-def dither_function(dither_path, image_path):
-    def dither(img):
-        working_image_path = f"{image_path}/temp.png"
-        out_path = f"{image_path}/temp_dither.png"
-        img.save(working_image_path)
-        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
-        args = [f'{dither_path}',
-                f'{working_image_path}', '-n', '5', '-m', '50', 'dither', '-o', f'{out_path}']
-
-        print(args)
-        dither_return_code = subprocess.call(args)
-        if not dither_return_code == 0:
-            log(LogLevel.ERROR, LogCategory.DITHERING, "Dithering failed")
-            exit(1)
-        return Image.open(out_path)
-
-    def dither_red(img):
-        working_image_path = f"{image_path}/temp.png"
-        out_path = f"{image_path}/temp_dither.png"
-        img.save(working_image_path)
-        log(LogLevel.INFO, LogCategory.DITHERING, "Dithering album art")
-        args = [f'{dither_path}',
-                f'{working_image_path}', '-n', '5', '-m', '50', 'dither', '-o', f'{out_path}', '-c',  'E42C35']
-
-        print(args)
-        dither_return_code = subprocess.call(args)
-        if not dither_return_code == 0:
-            log(LogLevel.ERROR, LogCategory.DITHERING, "Dithering failed")
-            exit(1)
-        return Image.open(out_path)
-
-    return dither, dither_red
-
-
-if len(argv) < 3:
-    print("Provide arguments for dither command and image folder")
-    exit(1)
+def next_poll_delay(playback):
+    # Seconds from one poll to the next, see config.py
+    if playback is None:
+        return poll_inactive
+    if not playback['is_playing']:
+        return poll_paused
 
-dither_path = argv[1]
-image_path = argv[2]
+    remaining = (playback['duration_ms'] - playback['progress_ms']) / 1000
+    return max(poll_near_end, min(poll_heartbeat, remaining - poll_track_end_lead))
 
-api = S.Spotify(secrets.client_id, secrets.client_secret,
-                secrets.refresh_token)
 
-current_song = None
-sleep_active = 5
-sleep_inactive = 15
+def put_latest(queue, item):
+    # The pipeline queues hold one item, the newest, anything older is stale
+    while not queue.empty():
+        queue.get_nowait()
+    queue.put_nowait(item)
 
-dither, dither_red = dither_function(dither_path, image_path)
 
-interfaces = [
-    BasicInterface(dither, img_width, img_height),
-    MirroredInterface(dither, img_width, img_height),
-    RawAlbumInterface(dither_red, img_width, img_height)
-]
+def log_failure(task):
+    if not task.cancelled() and task.exception() is not None:
+        log(LogLevel.ERROR, LogCategory.INTERFACE, f"Preparing song failed: {task.exception()!r}")
 
-with BasicDrawer() if platform == "win32" else EinkDrawer() as drawer:
-    counter = 0
+
+async def poll(songs):
+    # Puts every change of song (None when nothing's playing) on songs
+    loop = asyncio.get_running_loop()
+    current_song = None
     while True:
         log(LogLevel.INFO, LogCategory.SPOTIFY, "Refreshing current song")
-        new_song = api.current_song()
-        if new_song is None or current_song == new_song:
-            if new_song is None and not current_song is None:
-                drawer.wakeup()
-                drawer.clear()
-                drawer.sleep()
-            sleep_time = sleep_inactive if new_song is None else sleep_active
+        polled_at = time.monotonic()
+        new_song, playback = await loop.run_in_executor(poll_executor, api.current_playback)
+        if new_song != current_song:
+            if new_song is not None:
+                log(LogLevel.INFO, LogCategory.SONG,
+                    f"{new_song['song']} - {new_song['album']} - {new_song['artist']}")
             current_song = new_song
-            time.sleep(sleep_time)
+            put_latest(songs, new_song)
+        await asyncio.sleep(max(0, polled_at + next_poll_delay(playback) - time.monotonic()))
+
+
+async def prepare(songs, frames):
+    # Downloads the album art for and renders every song on songs into
+    # frames. A song that's still being prepared when the next one comes in
+    # is cancelled, so a skipped song never makes it to the display.
+    task = None
+    while True:
+        song = await songs.get()
+        if task is not None:
+            task.cancel()
+            task = None
+
+        if song is None:
+            put_latest(frames, None)
+        else:
+            task = asyncio.create_task(prepare_song(song, frames))
+            task.add_done_callback(log_failure)
+
+
+def interface_for(song):
+    # The interface a song is shown with, picked once so a song rendered ahead
+    # of time is shown the way it was rendered
+    key = (song['artist'], song['album'], song['song'])
+    if key not in planned_interfaces:
+        planned_interfaces[key] = random.choice(interfaces)
+        while len(planned_interfaces) > 64:
+            del planned_interfaces[next(iter(planned_interfaces))]
+    return planned_interfaces[key]
+
+
+def download(song, image_file_name):
+    # download_image in the background. There's only ever one download of a
+    # file going, anyone else after the same file waits for that one. It keeps
+    # going if the song that started it is cancelled.
+    pending = downloads.get(image_file_name)
+    if pending is None:
+        loop = asyncio.get_running_loop()
+        pending = loop.run_in_executor(
+            network_executor, download_image, api, song['album_url'], image_file_name)
+        downloads[image_file_name] = pending
+        pending.add_done_callback(lambda _: downloads.pop(image_file_name, None))
+    return asyncio.shield(pending)
+
+
+async def render(song):
+    # Downloads the album art and renders song, None if the art couldn't be
+    # downloaded
+    loop = asyncio.get_running_loop()
+
+    image_name = f'{song["artist"]} - {song["album"]}'
+    image_file_name = get_file_name(image_name, image_path)
+
+    download_result = await download(song, image_file_name)
+
+    if not download_result:
+        log(LogLevel.ERROR, LogCategory.ALBUMART, "Error downloading image")
+        return None
+
+    return await loop.run_in_executor(
+        render_executor, render_cache.create, interface_for(song), image_file_name, song)
+
+
+async def prepare_song(song, frames):
+    frame = await render(song)
+    if frame is None:
+        return
+    put_latest(frames, frame)
+
+    # Render what's coming up next while this song plays, so a change to one
+    # of them is a render cache hit. Cancelled like the rest of this task if
+    # the song changes first.
+    if not prefetch_songs:
+        return
+    loop = asyncio.get_running_loop()
+    upcoming = await loop.run_in_executor(network_executor, api.upcoming_songs, prefetch_songs)
+    for next_song in upcoming:
+        if next_song == song:
             continue
-        current_song = new_song
         log(LogLevel.INFO, LogCategory.SONG,
-            f"{current_song['song']} - {current_song['album']} - {current_song['artist']}")
-
-        # Download album art
-        if current_song is None:
-            exit(1)
+            f"Preparing {next_song['song']} - {next_song['album']} - {next_song['artist']} ahead of time")
+        await render(next_song)
 
-        image_name = f'{current_song["artist"]} - {current_song["album"]}'
-        image_file_name = get_file_name(image_name, image_path)
 
-        download_result = download_image(
-            api, current_song['album_url'], image_file_name)
+def show(drawer, frame, clear):
+    # draw wakes the display itself when the frame changed, so an unchanged
+    # frame doesn't cost a wakeup and sleep
+    if frame is not None and not clear:
+        drawer.draw(*frame)
+        return
 
-        if not download_result:
-            log(LogLevel.ERROR, LogCategory.ALBUMART, "Error downloading image")
-            exit(1)
+    drawer.wakeup()
+    # Hopefully this helps with the red bleeding into the black
+    drawer.clear()
+    if frame is not None:
+        drawer.draw(*frame)
+    drawer.sleep()
 
-        bw, red = random.choice(interfaces).create(
-            image_file_name, current_song)
 
-        drawer.wakeup()
-        if counter > 50:
+async def display(drawer, frames):
+    # Shows every frame on frames, None clears the display
+    loop = asyncio.get_running_loop()
+    counter = 0
+    while True:
+        frame = await frames.get()
+        clear = counter > 50
+        if clear:
             counter = 0
-            # Hopefully this helps with the red bleeding into the black
-            drawer.clear()
-        drawer.draw(bw, red)
-        counter += 1
+        await loop.run_in_executor(display_executor, show, drawer, frame, clear)
+        if frame is not None:
+            counter += 1
+
+
+async def run(drawer):
+    songs = asyncio.Queue(maxsize=1)
+    frames = asyncio.Queue(maxsize=1)
+    await asyncio.gather(poll(songs), prepare(songs, frames), display(drawer, frames))
+
+
+if len(argv) < 2:
+    print("Provide arguments for (optionally the dither command and) image folder")
+    exit(1)
+
+# main.py [dither command] <image folder>, without the dither command
+# dithering runs in process
+dither_path = argv[1] if len(argv) > 2 else None
+image_path = argv[-1]
 
-        drawer.sleep()
-        time.sleep(sleep_active)
+dither_cache = DitherCache(f'{image_path}/dithered', dither_cache_max_bytes)
+if dither_path is None:
+    log(LogLevel.INFO, LogCategory.DITHERING,
+        "No dither program given, dithering in process (close to, but not the same as, its output)")
+    dither, dither_red = dither_engine(cache=dither_cache)
+else:
+    dither, dither_red = dither_function(dither_path, cache=dither_cache)
+
+render_cache = RenderCache(f'{image_path}/rendered', render_cache_max_bytes)
+interfaces = [
+    BasicInterface(dither, img_width, img_height),
+    MirroredInterface(dither, img_width, img_height),
+    RawAlbumInterface(dither_red, img_width, img_height)
+]
+planned_interfaces = {}
+# Album art file -> future of its download, while it's downloading
+downloads = {}
+
+# Album art only needs to be as big as the largest any interface draws it
+api = S.Spotify(secrets.client_id, secrets.client_secret,
+                secrets.refresh_token,
+                max(interface.album_height for interface in interfaces))
+
+# Polling, the other Spotify requests and album art downloads, rendering, and
+# the display each get their own threads so none of them hold the others up
+poll_executor = ThreadPoolExecutor(max_workers=1)
+network_executor = ThreadPoolExecutor(max_workers=2)
+render_executor = ThreadPoolExecutor(max_workers=1)
+display_executor = ThreadPoolExecutor(max_workers=1)
+
+with BasicDrawer() if platform == "win32" else EinkDrawer(background=True) as drawer:
+    asyncio.run(run(drawer))
@@ -3,14 +3,31 @@ import pprint
 import requests
 import time
 
+from collections import deque
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 
+from config import spotify_timeout
 from Log import log, LogLevel, LogCategory
 
 class Spotify:
     def authenticate(self):
         print ("not right now")
 
+    def request(self, method, url, **kwargs):
+        # All HTTP goes through the one session so the connections to Spotify
+        # are kept alive between polls, and every request gets timeouts and
+        # has its latency recorded
+        start = time.perf_counter()
+        status = None
+        try:
+            r = self.session.request(method, url, timeout=spotify_timeout, **kwargs)
+            status = r.status_code
+            return r
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.latencies.append((method, url, status, elapsed_ms))
+
     def make_request(self, url):
         if (int(time.time()) >= self.expiration_time) or not self.access_token:
             self.refresh_auth()
@@ -18,7 +35,7 @@ class Spotify:
         headers = {'Authorization': f'Bearer {self.access_token}'}
         
         try:
-            r = requests.get(url, headers=headers)
+            r = self.request('GET', url, headers=headers)
             if not (r.status_code == 200 or r.status_code == 204):
                 log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned status code {r.status_code}")
                 log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned {r.text}")
@@ -28,7 +45,8 @@ class Spotify:
                     time.sleep(timeout)
 
                 self.refresh_auth()
-                r = requests.get(url, headers=headers)
+                headers = {'Authorization': f'Bearer {self.access_token}'}
+                r = self.request('GET', url, headers=headers)
                 if not (r.status_code == 200 or r.status_code == 204):
                     log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned status code {r.status_code}")
                     log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned {r.text}")
@@ -46,8 +64,12 @@ class Spotify:
         payload = { 'grant_type': 'refresh_token', 'refresh_token': self.refresh_token }
         headers = {'Authorization': f'Basic {hashed_client_code.decode("utf-8")}'}
 
-        r = requests.post("https://accounts.spotify.com/api/token", data=payload, headers=headers)
-        
+        try:
+            r = self.request('POST', "https://accounts.spotify.com/api/token", data=payload, headers=headers)
+        except requests.RequestException as e:
+            log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Refreshing auth token failed: {e}")
+            return
+
         if not r.status_code == 200:
             log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned status code {r.status_code}")
             log(LogLevel.ERROR, LogCategory.SPOTIFY, f"Request returned {r.text}")
@@ -59,28 +81,71 @@ class Spotify:
         # log(LogLevel.INFO, LogCategory.SPOTIFY, f'Auth Token: {self.access_token}')
         log(LogLevel.INFO, LogCategory.SPOTIFY, f'Expiry Time: {datetime.fromtimestamp(self.expiration_time).strftime("%Y-%m-%d %H:%M:%S")}')
 
-    def current_song(self, second_try=False):
+    def song_info(self, track):
+        # The parts of a track object the interfaces use
+        data = {}
+        data['artist'] = track['artists'][0]['name']
+        data['album'] = track['album']['name']
+        data['release_date'] = track['album']['release_date']
+        data['song'] = track['name']
+        data['song_popularity'] = track['popularity']
+        data['total_tracks'] = track['album']['total_tracks']
+        data['track_number'] = track['track_number']
+
+        # The smallest image that's at least album_height tall, the biggest
+        # there is without an album_height or if none are. Spotify leaves the
+        # height out on some images, those are only used as a last resort.
+        album_urls = [(image['height'], image['url']) for image in track['album']['images']]
+        sized = sorted((img for img in album_urls if img[0] is not None), key=lambda img: img[0])
+        unsized = [img for img in album_urls if img[0] is None]
+        big_enough = []
+        if self.album_height is not None:
+            big_enough = [img for img in sized if img[0] >= self.album_height]
+        album_image = (big_enough or sized[-1:] or unsized)[0]
+
+        data['album_url'] = album_image[1]
+        data['album_image_height'] = int(album_image[0] or 0)
+        return data
+
+    def upcoming_songs(self, count):
+        # The next count songs in the user's queue, like current_song returns
+        # them. Anything that isn't a track (podcast episodes) is skipped.
+        code, result = self.make_request("https://api.spotify.com/v1/me/player/queue")
+        if not code == 200:
+            return []
+
+        songs = []
+        for item in result.json().get('queue', []):
+            if len(songs) == count:
+                break
+            if item.get('type') != 'track':
+                continue
+            try:
+                songs.append(self.song_info(item))
+            except (KeyError, IndexError, TypeError, ValueError):
+                log(LogLevel.ERROR, LogCategory.SPOTIFY, "Error parsing queued song")
+        return songs
+
+    def current_song(self):
+        return self.current_playback()[0]
+
+    def current_playback(self, second_try=False):
+        # (song, playback) where playback is how far into the song we are:
+        # progress_ms, duration_ms and is_playing. (None, None) if nothing is
+        # playing.
         code, result = self.make_request("https://api.spotify.com/v1/me/player/currently-playing")
         if not code == 200:
-            return None
+            return None, None
 
         result = result.json()
 
-        data = {}
         try:
-            data['artist'] = result['item']['artists'][0]['name']
-            data['album'] = result['item']['album']['name']
-            data['release_date'] = result['item']['album']['release_date']
-            data['song'] = result['item']['name']
-            data['song_popularity'] = result['item']['popularity']
-            data['total_tracks'] = result['item']['album']['total_tracks']
-            data['track_number'] = result['item']['track_number']
-
-            album_urls = [(image['height'], image['url']) for image in result['item']['album']['images']]
-            biggest_image = sorted(album_urls, key=lambda img: img[0], reverse=True)
-
-            data['album_url'] = biggest_image[0][1]
-            data['album_image_height'] = int(biggest_image[0][0])
+            data = self.song_info(result['item'])
+
+            playback = {}
+            playback['progress_ms'] = result['progress_ms'] or 0
+            playback['duration_ms'] = result['item']['duration_ms']
+            playback['is_playing'] = result['is_playing']
         except:
             log(LogLevel.ERROR, LogCategory.SPOTIFY, "Error parsing current song")
             pp = pprint.PrettyPrinter(indent=4)
@@ -88,16 +153,28 @@ class Spotify:
             if not second_try:
                 log(LogLevel.INFO, LogCategory.SPOTIFY, "Sleeping for 1 second and then trying again")
                 time.sleep(1)
-                return self.current_song(True)
+                return self.current_playback(True)
             else:
                 log(LogLevel.INFO, LogCategory.SPOTIFY, "Already tried twice, return None")
-                return None
+                return None, None
 
-        return data
+        return data, playback
 
         
-    def __init__(self, client_id, client_secret, refresh_token):
+    def __init__(self, client_id, client_secret, refresh_token, album_height=None):
         self.client_id = client_id
         self.client_secret = client_secret
         self.refresh_token = refresh_token
+        # Height in pixels the album art is drawn at, see song_info
+        self.album_height = album_height
+
+        self.access_token = None
+        self.expiration_time = 0
+
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=1))
+        # (method, url, status code or None if it failed, milliseconds) of the
+        # most recent requests
+        self.latencies = deque(maxlen=256)
+
         self.refresh_auth()
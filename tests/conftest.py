@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The drivers pick their SPI/GPIO backend when epdconfig is imported, tests
+# run against the simulated one
+os.environ.setdefault('EPD_SIMULATE', 'epd5in83b_V2')
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
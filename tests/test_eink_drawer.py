@@ -0,0 +1,43 @@
+import pytest
+
+from PIL import Image
+
+from ImageDrawer import EinkDrawer
+from lib.waveshare_epd import epdconfig
+
+# epd5in83b_V2's deep sleep command, sent at the end of every sleep()
+DEEP_SLEEP = 0x07
+
+
+def commands(drawer, *args):
+    # Commands the simulated panel received while drawing args
+    epdconfig.implementation.reset_stats()
+    drawer.draw(*args)
+    if drawer.worker is not None:
+        drawer.run("sync", lambda: None).result()
+    return [command for _, command, _ in epdconfig.implementation.transactions()]
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_panel_sleeps_after_every_refresh(background):
+    with EinkDrawer(background=background) as drawer:
+        size = (drawer.panel.epd.width, drawer.panel.epd.height)
+        white = Image.new('L', size, 255)
+        black = Image.new('L', size, 0)
+
+        for frame in [black, white, black]:
+            sent = commands(drawer, frame, white)
+            assert sent[-1] == DEEP_SLEEP
+        assert drawer.awake is False
+
+
+@pytest.mark.parametrize('background', [False, True])
+def test_unchanged_frame_sends_nothing(background):
+    with EinkDrawer(background=background) as drawer:
+        size = (drawer.panel.epd.width, drawer.panel.epd.height)
+        white = Image.new('L', size, 255)
+        black = Image.new('L', size, 0)
+
+        commands(drawer, black, white)
+        assert commands(drawer, black, white) == []
+        assert drawer.refreshes_saved == 1
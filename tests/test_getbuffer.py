@@ -0,0 +1,101 @@
+import glob
+import importlib
+import os.path
+import random
+
+import pytest
+
+from PIL import Image
+
+# The per-pixel getbuffer loops the drivers used before epdbuffer, kept as the
+# reference the packed buffers have to match byte for byte
+
+
+def reference_1bpp(image, width, height, mirror=False):
+    linewidth = (width + 7) // 8
+    buf = [0xFF] * (linewidth * height)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+    if imwidth == width and imheight == height:
+        for y in range(imheight):
+            for x in range(imwidth):
+                if pixels[x, y] == 0:
+                    if mirror:
+                        x = imwidth - x
+                    buf[int(x / 8) + y * linewidth] &= ~(0x80 >> (x % 8))
+    elif imwidth == height and imheight == width:
+        for y in range(imheight):
+            for x in range(imwidth):
+                newx = y
+                newy = height - x - 1
+                if pixels[x, y] == 0:
+                    if mirror:
+                        newy = imwidth - newy - 1
+                    buf[int(newx / 8) + newy * linewidth] &= ~(0x80 >> (y % 8))
+    return buf
+
+
+def reference_2bpp(image, width, height):
+    buf = [0x00] * int(width * height / 4)
+    image_monocolor = image.convert('1')
+    imwidth, imheight = image_monocolor.size
+    pixels = image_monocolor.load()
+
+    def put(i, shift, value):
+        if value < 64:
+            buf[i] &= ~(0xC0 >> shift)
+        elif value < 192:
+            buf[i] &= ~(0xC0 >> shift)
+            buf[i] |= 0x40 >> shift
+        else:
+            buf[i] |= 0xC0 >> shift
+
+    if imwidth == width and imheight == height:
+        for y in range(imheight):
+            for x in range(imwidth):
+                put(int((x + y * width) / 4), x % 4 * 2, pixels[x, y])
+    elif imwidth == height and imheight == width:
+        for y in range(imheight):
+            for x in range(imwidth):
+                newx = y
+                newy = height - x - 1
+                put(int((newx + newy * width) / 4), y % 4 * 2, pixels[x, y])
+    return buf
+
+
+MIRRORED = {'epd2in13_V2'}
+TWO_BITS = {'epd5in83', 'epd7in5'}
+# These only take images the exact size of the panel
+EXACT_SIZE = {'epd1in54b', 'epd1in54b_V2'}
+# 7 colour panels, their getbuffer isn't a 1bpp one
+SKIP = {'epd4in01f', 'epd5in65f'}
+
+DRIVERS = sorted(
+    name for name in (os.path.basename(path)[:-3] for path in
+                      glob.glob(os.path.join(os.path.dirname(__file__), '..', 'lib', 'waveshare_epd', 'epd[0-9]*.py')))
+    if name not in SKIP)
+
+
+def random_image(size, rng):
+    return Image.frombytes('RGB', size, bytes(rng.randrange(256) for _ in range(size[0] * size[1] * 3)))
+
+
+@pytest.mark.parametrize('name', DRIVERS)
+def test_getbuffer_matches_pixel_loop(name):
+    epd = importlib.import_module(f'lib.waveshare_epd.{name}').EPD()
+    rng = random.Random(name)
+
+    # Upright, on its side, and a size the panel doesn't take
+    for size in [(epd.width, epd.height), (epd.height, epd.width), (epd.width + 1, epd.height)]:
+        image = random_image(size, rng)
+        if name in EXACT_SIZE and size != (epd.width, epd.height):
+            with pytest.raises(ValueError):
+                epd.getbuffer(image)
+            continue
+
+        if name in TWO_BITS:
+            expected = reference_2bpp(image, epd.width, epd.height)
+        else:
+            expected = reference_1bpp(image, epd.width, epd.height, name in MIRRORED)
+        assert bytes(epd.getbuffer(image)) == bytes(expected), size
@@ -0,0 +1,60 @@
+import random
+
+from PIL import Image
+
+from AlbumDisplay import split_red
+
+
+def reference_split(bw):
+    # RawAlbumInterface's original per-pixel loops
+    def is_red(pixel):
+        return pixel[0] > 200 and pixel[1] < 10 and pixel[2] < 10
+
+    def is_black(pixel):
+        return pixel[0] < 10 and pixel[1] < 10 and pixel[2] < 10
+
+    bw_image = bw.copy()
+    bw_pixels = bw_image.load()
+    for x in range(bw_image.width):
+        for y in range(bw_image.height):
+            if is_red(bw_pixels[x, y]):
+                bw_pixels[x, y] = (255, 255, 255)
+
+    red_image = bw.copy()
+    red_pixels = red_image.load()
+    for x in range(red_image.width):
+        for y in range(red_image.height):
+            if is_black(red_pixels[x, y]):
+                red_pixels[x, y] = (255, 255, 255)
+            if is_red(red_pixels[x, y]):
+                red_pixels[x, y] = (0, 0, 0)
+
+    # What EinkDrawer turned them into
+    return bw_image.convert('1', dither=Image.NONE), red_image.convert('1', dither=Image.NONE)
+
+
+def assert_same_planes(img):
+    bw, red = split_red(img)
+    expected_bw, expected_red = reference_split(img)
+    assert bw.mode == red.mode == '1'
+    assert bw.tobytes() == expected_bw.tobytes()
+    assert red.tobytes() == expected_red.tobytes()
+
+
+def test_split_red_threshold_edges():
+    # Every combination of the channel values either side of the thresholds
+    values = [0, 9, 10, 11, 127, 128, 199, 200, 201, 255]
+    pixels = bytes(channel for r in values for g in values for b in values for channel in (r, g, b))
+    assert_same_planes(Image.frombytes('RGB', (len(values), len(values) ** 2), pixels))
+
+
+def test_split_red_random_image():
+    rng = random.Random(0)
+    assert_same_planes(Image.frombytes('RGB', (96, 64), bytes(rng.randrange(256) for _ in range(96 * 64 * 3))))
+
+
+def test_split_red_dithered_palette():
+    rng = random.Random(1)
+    colours = [(0, 0, 0), (255, 255, 255), (255, 0, 0)]
+    pixels = bytes(channel for _ in range(64 * 64) for channel in rng.choice(colours))
+    assert_same_planes(Image.frombytes('RGB', (64, 64), pixels))